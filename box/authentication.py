@@ -7,7 +7,8 @@ import os
 
 from oauthlib.oauth2.rfc6749.clients.base import AUTH_HEADER
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 from tornado.httpclient import HTTPError as AsyncHTTPError
 
 from vizydrop.sdk.account import AppOAuthv2Account
@@ -53,7 +54,7 @@ class BoxOAuth(AppOAuthv2Account):
     def validate(self):
         try:
             yield self.do_token_refresh()
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://api.box.com/2.0/users/me")
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
@@ -66,7 +67,7 @@ class BoxOAuth(AppOAuthv2Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://api.box.com/2.0/users/me")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
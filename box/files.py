@@ -1,7 +1,8 @@
 from tornado import gen, locks
 import json
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 
 from tornado.log import app_log
 
@@ -44,7 +45,7 @@ class BoxFileFilter(SourceFilter):
                 app_log.info("Fetching page {}".format(page_no))
                 working.add(current_url)
                 req = account.get_request(current_url)
-                client = AsyncHTTPClient()
+                client = get_http_client()
                 response = yield client.fetch(req)
                 done.add(current_url)
                 app_log.info("Page {} downloaded".format(page_no))
@@ -104,7 +105,7 @@ class BoxFileSource(StreamingDataSource):
 
         app_log.info("Starting to retrieve file {} => {}".format(source_filter.file, account._id))
 
-        client = AsyncHTTPClient()
+        client = get_http_client()
         uri = "https://api.box.com/2.0/files/{}/content".format(source_filter.file.lstrip('/'))
         lock = locks.Condition()
 
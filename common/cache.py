@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from hashlib import sha1
+import time
+
+
+def get_credential_key(*credentials):
+    """
+    Gets a key standing for a set of credentials, so what we cache for one user is never served to another; the
+    credentials are hashed, so they don't sit around in our caches
+    :param credentials: credential strings, e.g. an access token, or a username and password
+    :return: hex digest
+    """
+    return sha1('\0'.join(str(credential) for credential in credentials).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Bounded in-memory cache; least recently used entries are evicted first and entries may expire after a TTL
+    """
+
+    def __init__(self, max_entries=1000, ttl=None, max_size=None, get_size=None):
+        """
+        :param max_entries: maximum number of entries to hold
+        :param ttl: default time-to-live for entries (in seconds), None to never expire
+        :param max_size: maximum total size of the entries we hold, as measured by get_size (None for no limit)
+        :param get_size: function measuring the size of a value, e.g. in bytes
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self._get_size = get_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return self._entries.__len__()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Gets a value from the cache
+        :param key: cache key
+        :param default: value to return if we have no live entry for the key
+        :return: cached value
+        """
+        try:
+            value, expires, size = self._entries[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.monotonic():
+            self._remove(key)
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value in the cache
+        :param key: cache key
+        :param value: value to store
+        :param ttl: time-to-live for this entry (in seconds), defaults to the cache's TTL
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        size = self._get_size(value) if self._get_size is not None else 0
+        self._remove(key)
+        if self.max_size is not None and size > self.max_size:
+            # we'd have to give up everything else for it
+            return
+        self._entries[key] = (value, expires, size)
+        self.size += size
+        while self._entries.__len__() > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def pop(self, key, default=None):
+        """
+        Removes an entry from the cache
+        :param key: cache key
+        :param default: value to return if we have no entry for the key
+        :return: the removed value
+        """
+        value = self.get(key, default)
+        self._remove(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
@@ -0,0 +1,82 @@
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.locks import Semaphore
+from tornado.log import app_log
+
+try:
+    import pycurl
+except ImportError:
+    # we fall back to Tornado's simple HTTP client when curl isn't available
+    pycurl = None
+
+# how many requests can we have in flight at once, across all hosts?
+MAX_CLIENTS = 100
+# how many requests can we have in flight at once to a single host?
+MAX_CLIENTS_PER_HOST = 20
+
+
+def _prepare_curl(curl):
+    """
+    Tunes each curl handle before a request is made with it
+    """
+    # curl reuses its handles' connections by itself; TCP keep-alive probes stop idle ones from being dropped
+    # along the way (e.g. by NAT) while they wait in our pool
+    if hasattr(pycurl, 'TCP_KEEPALIVE'):
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+    # and multiplex over HTTP/2 where both libcurl and the server support it
+    if hasattr(pycurl, 'CURL_HTTP_VERSION_2TLS') and pycurl.version_info()[4] & pycurl.VERSION_HTTP2:
+        curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+
+
+if pycurl is not None:
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=MAX_CLIENTS,
+                              defaults={'prepare_curl_callback': _prepare_curl})
+else:
+    app_log.warning("pycurl isn't installed; falling back to Tornado's simple HTTP client, which opens a new connection "
+                    "(and TLS session) for every request")
+    AsyncHTTPClient.configure(None, max_clients=MAX_CLIENTS)
+
+
+class PooledHTTPClient(object):
+    """
+    Our shared HTTP client; requests go through one tuned AsyncHTTPClient, with a cap on the requests in flight
+    to any one host
+    """
+
+    def __init__(self, max_per_host=MAX_CLIENTS_PER_HOST):
+        self._host_limits = defaultdict(lambda: Semaphore(max_per_host))
+
+    def fetch(self, request, callback=None, raise_error=True, **kwargs):
+        """
+        Executes a request, asynchronously returning an `HTTPResponse`; mirrors `AsyncHTTPClient.fetch`
+        """
+        if not isinstance(request, HTTPRequest):
+            request = HTTPRequest(url=request, **kwargs)
+        if callback is not None:
+            # in the callback interface, errors are handed to the callback rather than raised
+            raise_error = False
+        return self._fetch(request, callback, raise_error)
+
+    @gen.coroutine
+    def _fetch(self, request, callback, raise_error):
+        host_limit = self._host_limits[urlparse(request.url).hostname]
+        yield host_limit.acquire()
+        try:
+            response = yield AsyncHTTPClient().fetch(request, callback=callback, raise_error=raise_error)
+        finally:
+            host_limit.release()
+        return response
+
+
+_client = PooledHTTPClient()
+
+
+def get_http_client():
+    """
+    Gets our shared, pooled HTTP client
+    :return: PooledHTTPClient
+    """
+    return _client
@@ -0,0 +1,168 @@
+import codecs
+import json
+import re
+
+# JSON insignificant whitespace
+whitespace_regex = re.compile(r'[ \t\n\r]*')
+
+
+class JSONArrayStreamParser(object):
+    """
+    Incrementally parses a JSON object as it arrives in chunks, handing off each element of one of its array
+    members as soon as that element is complete, so the whole page never has to be held in memory
+
+    Feed it from an HTTPRequest's streaming_callback, then close it once the response is done to get at the
+    object's other members.
+    """
+
+    def __init__(self, array_key, on_item):
+        """
+        :param array_key: name of the object member holding the array to stream, e.g. Items
+        :param on_item: function called with each element of the array, in order
+        """
+        self.array_key = array_key
+        self.on_item = on_item
+        self.members = {}
+        self.item_count = 0
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._state = 'start'
+        self._key = None
+        self._error = None
+
+    def feed(self, chunk):
+        """
+        Feeds the next chunk of the response into the parser
+        :param chunk: bytes
+        """
+        if self._error is not None:
+            return
+        try:
+            self._buffer += self._text_decoder.decode(chunk)
+            self._parse()
+        except Exception as err:
+            # we're called from within the HTTP client, so hold on to this until we're closed
+            self._error = err
+
+    def close(self):
+        """
+        Finishes parsing
+        :return: dict of the object's members, other than the streamed array
+        """
+        if self._error is None:
+            self.feed(b'')
+        if self._error is not None:
+            raise self._error
+        if self._state != 'done':
+            raise ValueError("incomplete JSON response: expected an object with an array member {}"
+                             .format(self.array_key))
+        return self.members
+
+    def _skip_whitespace(self, pos):
+        return whitespace_regex.match(self._buffer, pos).end()
+
+    def _decode_value(self, pos):
+        """
+        Decodes the value starting at pos, or returns None if it hasn't completely arrived yet
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, pos)
+        except ValueError:
+            return None
+        if end >= self._buffer.__len__():
+            # a value inside an object or array is always followed by something; if we're at the end of our
+            # buffer, a number may have been cut short
+            return None
+        return value, end
+
+    def _parse(self):
+        pos = 0
+        buffer_length = self._buffer.__len__()
+        while True:
+            pos = self._skip_whitespace(pos)
+            if pos >= buffer_length or self._state == 'done':
+                break
+            char = self._buffer[pos]
+            if self._state == 'start':
+                if char != '{':
+                    raise ValueError("expected a JSON object, found {!r}".format(char))
+                pos += 1
+                self._state = 'key'
+            elif self._state == 'key':
+                if char == ',':
+                    pos += 1
+                    continue
+                if char == '}':
+                    pos += 1
+                    self._state = 'done'
+                    continue
+                decoded = self._decode_value(pos)
+                if decoded is None:
+                    break
+                self._key, pos = decoded
+                self._state = 'colon'
+            elif self._state == 'colon':
+                if char != ':':
+                    raise ValueError("expected ':', found {!r}".format(char))
+                pos += 1
+                self._state = 'value'
+            elif self._state == 'value':
+                if self._key == self.array_key and char == '[':
+                    pos += 1
+                    self._state = 'items'
+                    continue
+                decoded = self._decode_value(pos)
+                if decoded is None:
+                    break
+                self.members[self._key], pos = decoded
+                self._state = 'key'
+            elif self._state == 'items':
+                if char == ',':
+                    pos += 1
+                    continue
+                if char == ']':
+                    pos += 1
+                    self._state = 'key'
+                    continue
+                decoded = self._decode_value(pos)
+                if decoded is None:
+                    break
+                item, pos = decoded
+                self.item_count += 1
+                self.on_item(item)
+        # drop everything we've consumed
+        self._buffer = self._buffer[pos:]
+
+
+class StreamedPage(object):
+    """
+    A page of results streamed in alongside other pages; its items are handed off as they arrive once the page
+    is at the head of the line, and held until then
+    """
+
+    def __init__(self, array_key, on_item):
+        """
+        :param array_key: name of the object member holding the page's items
+        :param on_item: function called with each item, in order
+        """
+        self.on_item = on_item
+        self.parser = JSONArrayStreamParser(array_key, self._receive)
+        self.future = None
+        self._is_head = False
+        self._held = []
+
+    def _receive(self, item):
+        if self._is_head:
+            self.on_item(item)
+        else:
+            self._held.append(item)
+
+    def make_head(self):
+        """
+        Moves the page to the head of the line, handing off anything held so far
+        """
+        self._is_head = True
+        held, self._held = self._held, []
+        for item in held:
+            self.on_item(item)
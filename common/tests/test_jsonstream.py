@@ -0,0 +1,121 @@
+import json
+import unittest
+
+from common.jsonstream import JSONArrayStreamParser, StreamedPage
+
+PAGE = {
+    'startAt': 0,
+    'maxResults': 50,
+    'issues': [
+        {'id': '10001', 'fields': {'summary': 'Brackets [in] {a} "string"', 'votes': 12, 'ratio': -0.5e-3}},
+        {'id': '10002', 'fields': {'summary': 'Ünïcödé and emoji \U0001f600', 'labels': [], 'parent': None}},
+        12345,
+        'a string item, with a comma',
+        [1, [2, [3]]],
+        True,
+        {},
+    ],
+    'total': 7,
+    'warningMessages': ['Escaped \\ backslash and \\"quote\\"'],
+}
+
+
+def parse(chunks, array_key='issues'):
+    items = []
+    parser = JSONArrayStreamParser(array_key, items.append)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return items, parser.close()
+
+
+class JSONArrayStreamParserTests(unittest.TestCase):
+    def setUp(self):
+        self.body = json.dumps(PAGE, indent=1).encode('utf-8')
+        self.members = dict((key, value) for key, value in PAGE.items() if key != 'issues')
+
+    def test_single_chunk(self):
+        items, members = parse([self.body])
+        self.assertEqual(items, PAGE['issues'])
+        self.assertEqual(members, self.members)
+
+    def test_every_split(self):
+        for split in range(self.body.__len__() + 1):
+            items, members = parse([self.body[:split], self.body[split:]])
+            self.assertEqual(items, PAGE['issues'], split)
+            self.assertEqual(members, self.members, split)
+
+    def test_every_chunk_size(self):
+        # one byte at a time splits every multibyte character and every number along the way
+        for size in range(1, 17):
+            chunks = [self.body[start:start + size] for start in range(0, self.body.__len__(), size)]
+            items, members = parse(chunks)
+            self.assertEqual(items, PAGE['issues'], size)
+            self.assertEqual(members, self.members, size)
+
+    def test_compact(self):
+        body = json.dumps(PAGE, separators=(',', ':')).encode('utf-8')
+        items, members = parse([body[start:start + 1] for start in range(body.__len__())])
+        self.assertEqual(items, PAGE['issues'])
+        self.assertEqual(members, self.members)
+
+    def test_items_handed_off_as_they_arrive(self):
+        items = []
+        parser = JSONArrayStreamParser('Items', items.append)
+        parser.feed(b'{"Items": [{"Id": 1}, {"Id": 2}, {"I')
+        self.assertEqual(items, [{'Id': 1}, {'Id': 2}])
+        parser.feed(b'd": 3}]}')
+        self.assertEqual(parser.close(), {})
+        self.assertEqual(items, [{'Id': 1}, {'Id': 2}, {'Id': 3}])
+        self.assertEqual(parser.item_count, 3)
+
+    def test_number_cut_short(self):
+        items, members = parse([b'{"Items": [12', b'34], "Next": 5', b'6}'], array_key='Items')
+        self.assertEqual(items, [1234])
+        self.assertEqual(members, {'Next': 56})
+
+    def test_empty_array(self):
+        items, members = parse([b'{"Items": [], "Next": null}'], array_key='Items')
+        self.assertEqual(items, [])
+        self.assertEqual(members, {'Next': None})
+
+    def test_missing_array(self):
+        items, members = parse([b'{"Next": "x"}'], array_key='Items')
+        self.assertEqual(items, [])
+        self.assertEqual(members, {'Next': 'x'})
+
+    def test_not_an_object(self):
+        with self.assertRaises(ValueError):
+            parse([b'[1, 2, 3]'], array_key='Items')
+
+    def test_incomplete(self):
+        with self.assertRaises(ValueError):
+            parse([b'{"Items": [{"Id": 1}, {"Id": 2'], array_key='Items')
+
+    def test_error_held_until_closed(self):
+        items = []
+        parser = JSONArrayStreamParser('Items', items.append)
+        parser.feed(b'{"Items" [')
+        parser.feed(b'{"Id": 1}]}')
+        self.assertEqual(items, [])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+
+class StreamedPageTests(unittest.TestCase):
+    def test_held_until_head(self):
+        items = []
+        first = StreamedPage('Items', items.append)
+        second = StreamedPage('Items', items.append)
+        first.make_head()
+        # the second page arrives faster, but its items wait for the first page
+        second.parser.feed(b'{"Items": [3, 4')
+        first.parser.feed(b'{"Items": [1, ')
+        self.assertEqual(items, [1])
+        first.parser.feed(b'2]}')
+        first.parser.close()
+        self.assertEqual(items, [1, 2])
+        second.make_head()
+        self.assertEqual(items, [1, 2, 3])
+        second.parser.feed(b', 5]}')
+        second.parser.close()
+        self.assertEqual(items, [1, 2, 3, 4, 5])
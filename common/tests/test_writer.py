@@ -0,0 +1,92 @@
+import json
+import unittest
+
+from common.writer import RowWriter
+
+ROWS = [
+    {'id': 1, 'name': 'First', 'tags': ['a', 'b']},
+    {'id': 2, 'name': 'Ünïcödé', 'parent': None},
+    {'id': 3, 'name': 'With "quotes", and commas', 'ratio': 0.25},
+]
+
+
+class RowWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+
+    def test_empty(self):
+        writer = RowWriter(self.writes.append)
+        writer.open()
+        writer.close()
+        self.assertEqual(self.writes, ['[]'])
+        self.assertEqual(writer.count, 0)
+
+    def test_rows(self):
+        writer = RowWriter(self.writes.append)
+        writer.open()
+        for row in ROWS:
+            writer.write_row(row)
+        writer.close()
+        # everything fits in one chunk
+        self.assertEqual(self.writes.__len__(), 1)
+        self.assertEqual(json.loads(self.writes[0]), ROWS)
+        self.assertEqual(writer.count, ROWS.__len__())
+
+    def test_encoded_rows(self):
+        writer = RowWriter(self.writes.append)
+        writer.open()
+        writer.write_row(ROWS[0])
+        writer.write_encoded(json.dumps(ROWS[1]))
+        writer.write_row(ROWS[2])
+        writer.close()
+        self.assertEqual(json.loads(''.join(self.writes)), ROWS)
+
+    def test_chunks(self):
+        rows = [{'id': n, 'name': 'Row {}'.format(n)} for n in range(1000)]
+        writer = RowWriter(self.writes.append, chunk_size=256)
+        writer.open()
+        for row in rows:
+            writer.write_row(row)
+        self.assertGreater(self.writes.__len__(), 1)
+        writer.close()
+        self.assertEqual(json.loads(''.join(self.writes)), rows)
+        # each chunk is written once it reaches chunk_size, so none runs much over it
+        longest_row = max(json.dumps(row).__len__() for row in rows)
+        for chunk in self.writes[:-1]:
+            self.assertGreaterEqual(chunk.__len__(), 256)
+            self.assertLessEqual(chunk.__len__(), 256 + longest_row + 1)
+
+    def test_every_chunk_size(self):
+        expected = json.dumps(ROWS, separators=(',', ':'))
+        for chunk_size in range(1, expected.__len__() + 2):
+            writes = []
+            writer = RowWriter(writes.append, chunk_size=chunk_size)
+            writer.open()
+            for row in ROWS:
+                writer.write_row(row)
+            writer.close()
+            self.assertEqual(json.loads(''.join(writes)), ROWS, chunk_size)
+            self.assertNotIn('', writes, chunk_size)
+
+    def test_flush(self):
+        writer = RowWriter(self.writes.append)
+        writer.open()
+        writer.write_row(ROWS[0])
+        writer.flush()
+        self.assertEqual(self.writes.__len__(), 1)
+        # nothing left to write
+        writer.flush()
+        self.assertEqual(self.writes.__len__(), 1)
+        writer.write_row(ROWS[1])
+        writer.close()
+        self.assertEqual(json.loads(''.join(self.writes)), ROWS[:2])
+
+    def test_started(self):
+        writer = RowWriter(self.writes.append, chunk_size=64)
+        writer.open()
+        writer.write_row(ROWS[0])
+        # still gathering
+        self.assertFalse(writer.started)
+        for row in ROWS:
+            writer.write_row(row)
+        self.assertTrue(writer.started)
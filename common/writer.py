@@ -0,0 +1,72 @@
+import json
+
+# how much output (in characters) do we gather before writing it out?
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class RowWriter(object):
+    """
+    Writes a source's rows out as a JSON array, gathering them into chunks so a streaming source makes a few large
+    writes rather than a couple for every row
+    """
+
+    def __init__(self, write, chunk_size=WRITE_CHUNK_SIZE):
+        """
+        :param write: function to write each chunk with, usually the source's write
+        :param chunk_size: how much output (in characters) to gather before writing it out
+        """
+        self.chunk_size = chunk_size
+        self.count = 0
+        # has anything been written out yet? once it has, our caller can no longer respond with an error
+        self.started = False
+        self._write = write
+        self._encode = json.JSONEncoder(check_circular=False).encode
+        self._parts = []
+        self._size = 0
+
+    def _add(self, text):
+        self._parts.append(text)
+        self._size += text.__len__()
+        if self._size >= self.chunk_size:
+            self.flush()
+
+    def open(self):
+        """
+        Opens our array
+        """
+        self._add('[')
+
+    def write_row(self, row):
+        """
+        Writes a row
+        :param row: dict to write, encoded as JSON
+        """
+        self.write_encoded(self._encode(row))
+
+    def write_encoded(self, text):
+        """
+        Writes a row that's already been encoded as JSON
+        :param text: JSON text
+        """
+        if self.count > 0:
+            self._parts.append(',')
+            self._size += 1
+        self.count += 1
+        self._add(text)
+
+    def flush(self):
+        """
+        Writes out anything we've gathered
+        """
+        if self._parts:
+            self.started = True
+            self._write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def close(self):
+        """
+        Closes our array, and writes out everything we have left
+        """
+        self._add(']')
+        self.flush()
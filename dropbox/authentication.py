@@ -3,7 +3,8 @@ from tornado import gen
 
 import os
 from oauthlib.oauth2.rfc6749.clients.base import AUTH_HEADER
-from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, HTTPError
+from common.http import get_http_client
 
 from vizydrop.sdk.account import AppOAuthv2Account
 
@@ -42,7 +43,7 @@ class DropboxOAuth(AppOAuthv2Account):
     @gen.coroutine
     def validate(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://api.dropbox.com/1/account/info")
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
@@ -55,7 +56,7 @@ class DropboxOAuth(AppOAuthv2Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://api.dropbox.com/1/account/info")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
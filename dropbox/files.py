@@ -1,8 +1,12 @@
+from collections import deque
 from tornado import gen
 from datetime import timedelta
+from itertools import islice
 import json
+from urllib.parse import quote
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest, HTTPError
+from common.http import get_http_client
 from tornado.log import app_log
 
 from tornado.locks import BoundedSemaphore
@@ -20,7 +24,72 @@ FETCH_CONCURRENCY = 10
 # our maximum request time (in seconds)
 MAXIMUM_REQ_TIME = 30
 
-RESPONSE_SIZE_LIMIT = 10  # MB
+RESPONSE_SIZE_LIMIT = 500  # MB
+# how large a piece of a file do we download with each request (in bytes)?
+CHUNK_SIZE = 8 * 1024 * 1024
+# how many pieces of a file can we download at once? pieces ahead of the one being written out are held in memory, so
+# this also bounds our buffer at CHUNK_SIZE * CHUNK_CONCURRENCY
+CHUNK_CONCURRENCY = 4
+# how many times in a row can a piece fail to make any progress before we give up?
+CHUNK_RETRIES = 3
+# our maximum request time for a piece of a file (in seconds)
+CHUNK_REQ_TIME = 120
+
+
+class FileChunk(object):
+    """
+    A byte range of a file being downloaded; it's held in memory until it's at the head of the line, and written
+    straight out from then on
+    """
+
+    def __init__(self, start, end, write):
+        """
+        :param start: offset of the chunk's first byte
+        :param end: offset of the chunk's last byte
+        :param write: function to write the chunk's data out with, in order
+        """
+        self.start = start
+        self.end = end
+        self.received = 0
+        self.future = None
+        self._write = write
+        self._buffer = []
+        self._head = False
+        self._accepting = False
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def get_range(self):
+        """
+        Gets the Range header for what we have left to download
+        """
+        return 'bytes={}-{}'.format(self.start + self.received, self.end)
+
+    def header_callback(self, line):
+        # we only take data from a partial response; anything else (e.g. an error page) isn't part of our file
+        if line.startswith('HTTP/'):
+            self._accepting = line.split(' ')[1] == '206'
+
+    def streaming_callback(self, data):
+        if not self._accepting:
+            return
+        # never take more than our range
+        data = data[:self.__len__() - self.received]
+        self.received += data.__len__()
+        if self._head:
+            self._write(data)
+        else:
+            self._buffer.append(data)
+
+    def make_head(self):
+        """
+        Puts us at the head of the line; what we've received so far is written out, and the rest as it arrives
+        """
+        self._head = True
+        if self._buffer:
+            self._write(b''.join(self._buffer))
+            self._buffer = []
 
 
 class DropboxFileFilter(SourceFilter):
@@ -40,7 +109,7 @@ class DropboxFileFilter(SourceFilter):
                 app_log.info("Fetching page {}".format(page_no))
                 working.add(current_url)
                 req = account.get_request(current_url)
-                client = AsyncHTTPClient()
+                client = get_http_client()
                 response = yield client.fetch(req)
                 done.add(current_url)
                 app_log.info("Page {} downloaded".format(page_no))
@@ -88,9 +157,59 @@ class DropboxFileSource(StreamingDataSource):
     class Schema(SourceSchema):
         pass
 
+    @staticmethod
+    @gen.coroutine
+    def get_metadata(account, path):
+        """
+        Gets a file's metadata
+        GET https://api.dropbox.com/1/metadata/auto/:path
+        :return: metadata dict, including its size (bytes) and revision (rev)
+        """
+        response = yield get_http_client().fetch(
+            account.get_request("https://api.dropbox.com/1/metadata/auto/{}".format(quote(path))))
+        return json.loads(response.body.decode('utf-8'))
+
+    @staticmethod
+    @gen.coroutine
+    def fetch_chunk(account, uri, chunk):
+        """
+        Downloads a chunk of a file with a Range request; when a request fails, we pick up from where it left off
+        :param account: account to make the requests for
+        :param uri: file URI
+        :param chunk: FileChunk to download
+        """
+        client = get_http_client()
+        failures = 0
+        while chunk.received < chunk.__len__():
+            received = chunk.received
+            oauth_client = account.get_client()
+            req_uri, headers, body = oauth_client.add_token(uri, headers={'Range': chunk.get_range()})
+            req = HTTPRequest(req_uri, headers=headers, body=body, request_timeout=CHUNK_REQ_TIME,
+                              header_callback=chunk.header_callback, streaming_callback=chunk.streaming_callback)
+            try:
+                yield client.fetch(req)
+                if chunk.received == received:
+                    raise HTTPError(502, 'Dropbox returned nothing for {}'.format(chunk.get_range()))
+            except (HTTPError, IOError) as e:
+                if isinstance(e, HTTPError) and e.code < 500:
+                    # trying again won't help
+                    raise
+                # only requests that got us nowhere count against our retries
+                failures = failures + 1 if chunk.received == received else 0
+                if failures > CHUNK_RETRIES:
+                    raise
+                app_log.warning("Chunk of {} failed ({}), resuming with {}".format(uri, e, chunk.get_range()))
+
     @classmethod
     @gen.coroutine
     def get_data(cls, account, source_filter, limit=100, skip=0):
+        """
+        Streams a file from Dropbox
+        GET https://content.dropboxapi.com/1/files/auto/:path
+
+        The file is downloaded in CHUNK_SIZE pieces with Range requests, CHUNK_CONCURRENCY at a time, and written out
+        in order.
+        """
         source_filter = DropboxFileFilter(source_filter)
 
         if source_filter.file is None:
@@ -98,14 +217,34 @@ class DropboxFileSource(StreamingDataSource):
 
         app_log.info("Starting to retrieve file {} => {}".format(source_filter.file, account._id))
 
-        client = AsyncHTTPClient()
-        uri = "https://content.dropboxapi.com/1/files/auto/{}".format(source_filter.file.lstrip('/'))
-
-        def stream_callback(chunk):
-            cls.write(chunk)
-
-        oauth_client = account.get_client()
-        uri, headers, body = oauth_client.add_token(uri)
-        req = HTTPRequest(uri, headers=headers, body=body, streaming_callback=stream_callback)
-        yield client.fetch(req)
+        path = source_filter.file.lstrip('/')
+        metadata = yield cls.get_metadata(account, path)
+        size = int(metadata['bytes'])
+        if size > RESPONSE_SIZE_LIMIT * 1000000:
+            raise ValueError('file {} is larger than {} MB'.format(source_filter.file, RESPONSE_SIZE_LIMIT))
+        # every chunk comes from the same revision, even if the file changes while we're at it
+        uri = "https://content.dropboxapi.com/1/files/auto/{}?rev={}".format(quote(path), metadata['rev'])
+
+        chunks = iter(FileChunk(start, min(start + CHUNK_SIZE, size) - 1, cls.write)
+                      for start in range(0, size, CHUNK_SIZE))
+
+        def start_chunk(chunk):
+            chunk.future = cls.fetch_chunk(account, uri, chunk)
+            return chunk
+
+        # keep up to CHUNK_CONCURRENCY chunks in flight, writing them out in order
+        pending = deque(start_chunk(chunk) for chunk in islice(chunks, CHUNK_CONCURRENCY))
+        try:
+            while pending.__len__() > 0:
+                chunk = pending[0]
+                chunk.make_head()
+                yield chunk.future
+                pending.popleft()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append(start_chunk(chunk))
+        finally:
+            # if we're giving up, we don't care how the rest turn out
+            for chunk in pending:
+                chunk.future.add_done_callback(lambda f: f.exception())
         app_log.info("File {} retrieved for account {}".format(source_filter.file, account._id))
@@ -0,0 +1,319 @@
+from hashlib import sha1
+from io import BytesIO
+import os
+import sqlite3
+import time
+from urllib.parse import urlparse
+
+from tornado import gen
+from tornado.httpclient import HTTPResponse, HTTPError
+from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+
+from common.cache import LRUCache
+from common.http import get_http_client
+
+# how many responses do we keep in memory for conditional requests?
+RESPONSE_CACHE_SIZE = 2000
+# how much response body (in bytes) do we keep in memory, at most?
+RESPONSE_CACHE_MEMORY_SIZE = 64 * 1024 * 1024
+# how many responses do we keep on disk? (only if GITHUB_CACHE_PATH is set)
+RESPONSE_CACHE_DISK_SIZE = 50000
+# response headers we need to replay a cached response (pagination lives in Link)
+CACHED_HEADERS = ['Content-Type', 'Link']
+# how long do we gather up writes to our disk cache before committing them (in seconds)?
+DISK_WRITE_DELAY = 1
+# how many writes do we gather up at most?
+DISK_WRITE_BATCH = 200
+# how many requests do we have left before we start pacing ourselves until the limit resets?
+RATE_LIMIT_PACE_BELOW = 500
+# how long can we wait on a rate limit (in seconds) before giving up?
+MAXIMUM_RATE_LIMIT_WAIT = 60
+# how long do we back off from a secondary rate limit that doesn't come with a Retry-After (in seconds)?
+SECONDARY_LIMIT_BACKOFF = 60
+# how many times do we retry a rate limited request?
+RATE_LIMIT_RETRIES = 2
+
+
+class ConditionalResponseCache(object):
+    """
+    Holds GitHub responses along with their ETags, so we can make conditional requests and serve a 304 from here
+
+    Responses are kept in a bounded in-memory LRU cache, optionally backed by an SQLite database on disk. Writes to
+    disk are gathered up and committed together, so we don't stall every request on a commit of its own.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, path=None, max_disk_entries=RESPONSE_CACHE_DISK_SIZE,
+                 max_memory_size=RESPONSE_CACHE_MEMORY_SIZE):
+        self._memory = LRUCache(max_entries=max_entries, max_size=max_memory_size,
+                                get_size=lambda entry: entry[2].__len__())
+        self._max_disk_entries = max_disk_entries
+        self._disk = None
+        self._writes = 0
+        # rows waiting to be written to disk, by key
+        self._pending = {}
+        self._flush_scheduled = False
+        if path:
+            self._disk = sqlite3.connect(path)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS responses "
+                               "(key TEXT PRIMARY KEY, etag TEXT, headers TEXT, body BLOB, updated REAL)")
+            self._disk.commit()
+
+    @staticmethod
+    def get_key(token, url):
+        # we don't want tokens sitting around on disk, so keys are hashed
+        return sha1('{} {}'.format(token, url).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: tuple of (etag, headers, body), or None if we have nothing cached
+        """
+        entry = self._memory.get(key)
+        if entry is None and self._disk is not None:
+            row = self._pending.get(key, None)
+            if row is None:
+                row = self._disk.execute("SELECT etag, headers, body FROM responses WHERE key = ?",
+                                         (key, )).fetchone()
+            if row is not None:
+                entry = (row[0], HTTPHeaders.parse(row[1]), bytes(row[2]))
+                self._memory.set(key, entry)
+        return entry
+
+    def set(self, key, etag, headers, body):
+        headers = HTTPHeaders({name: headers[name] for name in CACHED_HEADERS if name in headers})
+        self._memory.set(key, (etag, headers, body))
+        if self._disk is None:
+            return
+        header_lines = ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.get_all())
+        self._pending[key] = (etag, header_lines, body, time.time())
+        if self._pending.__len__() >= DISK_WRITE_BATCH:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().call_later(DISK_WRITE_DELAY, self.flush)
+
+    def flush(self):
+        """
+        Writes the responses we've gathered up to disk, in one transaction
+        """
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        self._disk.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               [(key, ) + row for key, row in self._pending.items()])
+        self._writes += self._pending.__len__()
+        self._pending = {}
+        if self._writes >= 100:
+            # keep our disk cache bounded, too
+            self._disk.execute("DELETE FROM responses WHERE key NOT IN "
+                               "(SELECT key FROM responses ORDER BY updated DESC LIMIT ?)",
+                               (self._max_disk_entries, ))
+            self._writes = 0
+        self._disk.commit()
+
+
+response_cache = ConditionalResponseCache(path=os.environ.get('GITHUB_CACHE_PATH', None))
+
+
+def get_rate_limit_resource(request):
+    """
+    Works out which of GitHub's rate limits a request counts against
+    :param request: HTTPRequest
+    :return: resource name, as GitHub reports it in X-RateLimit-Resource
+    """
+    path = urlparse(request.url).path
+    if path.startswith('/graphql'):
+        return 'graphql'
+    if path.startswith('/search/'):
+        return 'search'
+    return 'core'
+
+
+class RateLimitGovernor(object):
+    """
+    Tracks GitHub's rate limits for each token, so every request made with the token can share its budget; each
+    resource (core, graphql, search) has a budget and reset time of its own
+
+    Once the remaining budget runs low, requests are paced evenly until the limit resets; when GitHub tells us to
+    back off (Retry-After, or a secondary rate limit), requests wait until it's over.
+    """
+
+    def __init__(self, max_tokens=1000):
+        self._budgets = LRUCache(max_entries=max_tokens)
+
+    def _get_budget(self, token, resource):
+        budget = self._budgets.get((token, resource))
+        if budget is None:
+            budget = {'remaining': None, 'reset': None, 'in_flight': 0, 'next_slot': 0, 'blocked_until': 0}
+            self._budgets.set((token, resource), budget)
+        return budget
+
+    def get_remaining(self, token, resource='core'):
+        """
+        Gets what's left of a token's budget, as of its last response
+        :param token: access token
+        :param resource: rate limit resource, e.g. core or graphql
+        :return: tuple of (requests remaining, epoch time the limit resets), or (None, None) if we don't know yet
+        """
+        budget = self._budgets.get((token, resource))
+        if budget is None:
+            return None, None
+        return budget['remaining'], budget['reset']
+
+    def reserve(self, token, resource='core'):
+        """
+        Reserves a request against a token's budget; every reservation must be followed by an update or a release
+        :param token: access token
+        :param resource: rate limit resource the request counts against
+        :return: tuple of (seconds to wait before making the request, seconds of pacing the reservation took up),
+        the latter being 0 if the request is waiting on the limit to reset (or on GitHub telling us to back off)
+        rather than being paced
+        """
+        now = time.time()
+        budget = self._get_budget(token, resource)
+        start = max(now, budget['blocked_until'])
+        interval = 0
+        remaining, reset = budget['remaining'], budget['reset']
+        if remaining is not None and reset is not None and reset > now:
+            # requests still in flight will come out of what GitHub last told us we have
+            available = remaining - budget['in_flight']
+            if available <= 0:
+                start = max(start, reset)
+            elif available < RATE_LIMIT_PACE_BELOW:
+                # spread what we have left evenly over the time until the reset
+                interval = (reset - now) / available
+                start = max(start, budget['next_slot'])
+                budget['next_slot'] = start + interval
+        budget['in_flight'] += 1
+        return start - now, interval
+
+    def release(self, token, resource='core', interval=0):
+        """
+        Settles a reservation; a request we didn't make also gives back the pacing it took up
+        :param token: access token
+        :param resource: rate limit resource the request was reserved against
+        :param interval: seconds of pacing to give back, as returned by reserve
+        """
+        budget = self._get_budget(token, resource)
+        budget['in_flight'] = max(budget['in_flight'] - 1, 0)
+        if interval > 0:
+            budget['next_slot'] = max(budget['next_slot'] - interval, 0)
+
+    @gen.coroutine
+    def acquire(self, token, resource='core'):
+        """
+        Waits until a request can be made with a token; while there's budget left we wait our turn however long
+        that is, but we give up rather than wait more than MAXIMUM_RATE_LIMIT_WAIT on the limit to reset
+        :param token: access token
+        :param resource: rate limit resource the request counts against
+        :return: seconds of pacing the request took up, to give back with release if the request isn't made
+        """
+        delay, interval = self.reserve(token, resource)
+        if delay > MAXIMUM_RATE_LIMIT_WAIT and interval == 0:
+            self.release(token, resource)
+            raise HTTPError(403, 'GitHub rate limit exceeded, resets in {} seconds'.format(int(delay)))
+        if delay > 0:
+            app_log.info("Waiting {:.1f} seconds on the GitHub rate limit".format(delay))
+            yield gen.sleep(delay)
+        return interval
+
+    def update(self, token, response, resource='core'):
+        """
+        Records the rate limit GitHub gave us with a response, settling the request's reservation
+        :param token: access token the request was made with
+        :param response: HTTPResponse
+        :param resource: rate limit resource the request was reserved against
+        :return: seconds to back off before retrying, or None if the request wasn't rate limited
+        """
+        self.release(token, resource)
+        headers = response.headers
+        budget = self._get_budget(token, headers.get('X-RateLimit-Resource', resource))
+        if 'X-RateLimit-Remaining' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers.get('X-RateLimit-Reset', 0))
+            if reset != budget['reset'] or budget['remaining'] is None:
+                # a new window
+                budget['reset'] = reset
+                budget['remaining'] = remaining
+                budget['next_slot'] = 0
+            else:
+                # responses can arrive out of order; GitHub only charges what it charges (a 304 is free), so within
+                # a window the lowest figure it's given us is the latest
+                budget['remaining'] = min(remaining, budget['remaining'])
+
+        if response.code not in (403, 429):
+            return None
+        if 'Retry-After' in headers:
+            backoff = int(headers['Retry-After'])
+        elif headers.get('X-RateLimit-Remaining', None) == '0':
+            backoff = budget['reset'] - time.time()
+        elif b'rate limit' in (response.body or b'').lower():
+            # a secondary rate limit
+            backoff = SECONDARY_LIMIT_BACKOFF
+        else:
+            # just forbidden
+            return None
+        backoff = max(backoff, 0)
+        budget['blocked_until'] = max(budget['blocked_until'], time.time() + backoff)
+        return backoff
+
+
+rate_limits = RateLimitGovernor()
+
+
+@gen.coroutine
+def _fetch_within_rate_limit(account, request):
+    """
+    Fetches a request once the account's rate limit allows, retrying if GitHub tells us to back off
+    :return: HTTPResponse, which may be an error
+    """
+    token = account.access_token
+    resource = get_rate_limit_resource(request)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        interval = yield rate_limits.acquire(token, resource)
+        try:
+            response = yield get_http_client().fetch(request, raise_error=False)
+        except Exception:
+            rate_limits.release(token, resource, interval)
+            raise
+        backoff = rate_limits.update(token, response, resource)
+        if backoff is None:
+            break
+        app_log.warning("GitHub rate limit hit, backing off for {} seconds".format(backoff))
+    return response
+
+
+@gen.coroutine
+def fetch(account, request):
+    """
+    Fetches a GitHub API request within the account's rate limit; GET requests send If-None-Match when we've seen
+    the URL before, and a 304 is answered from our cache (and doesn't count against GitHub's rate limit)
+    :param account: account the request was made for
+    :param request: HTTPRequest from account.get_request
+    :return: HTTPResponse
+    """
+    if request.method != 'GET':
+        # only GET requests can be made conditional
+        response = yield _fetch_within_rate_limit(account, request)
+        if response.error:
+            raise response.error
+        return response
+
+    key = ConditionalResponseCache.get_key(account.access_token, request.url)
+    cached = response_cache.get(key)
+    if cached is not None:
+        request.headers['If-None-Match'] = cached[0]
+
+    response = yield _fetch_within_rate_limit(account, request)
+    if response.code == 304 and cached is not None:
+        etag, headers, body = cached
+        return HTTPResponse(request, 200, headers=HTTPHeaders(headers), buffer=BytesIO(body),
+                            effective_url=response.effective_url, request_time=response.request_time)
+    if response.error:
+        raise response.error
+
+    etag = response.headers.get('ETag', None)
+    if response.code == 200 and etag is not None:
+        response_cache.set(key, etag, response.headers, response.body)
+    return response
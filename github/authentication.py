@@ -2,12 +2,14 @@ from urllib.parse import parse_qs
 import json
 import os
 from oauthlib.oauth2.rfc6749.clients.base import AUTH_HEADER
-from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, HTTPError
 
 from tornado import gen
 
+from common.cache import get_credential_key
 from vizydrop.sdk.account import AppOAuthv2Account
 from . import __version__
+from .api import fetch
 
 
 class GitHubOAuth(AppOAuthv2Account):
@@ -28,13 +30,20 @@ class GitHubOAuth(AppOAuthv2Account):
 
         additional_request_parameters = {"access_type": "offline", "approval_prompt": "force"}
 
-    def get_request(self, url, **kwargs):
+    def get_request(self, url, method='GET', body=None, **kwargs):
         client = self.get_client()
         headers = kwargs.pop('headers', {})
         # GitHub requires a user-agent be specified for all API requests
         headers['User-Agent'] = 'Vizydrop-Hermione/AppsGallery github/{}'.format(__version__)
-        uri, headers, body = client.add_token(url, headers=headers, **kwargs)
-        return HTTPRequest(uri, headers=headers, body=body)
+        uri, headers, body = client.add_token(url, http_method=method, body=body, headers=headers, **kwargs)
+        return HTTPRequest(uri, method=method, headers=headers, body=body)
+
+    @property
+    def credential_key(self):
+        """
+        Key for caching what this account can see
+        """
+        return get_credential_key(self.access_token)
 
     def finish_setup(self, provider_response):
         response_body = provider_response.body.decode('utf-8')
@@ -49,22 +58,22 @@ class GitHubOAuth(AppOAuthv2Account):
     @gen.coroutine
     def validate(self):
         try:
-            client = AsyncHTTPClient()
             req = self.get_request("https://api.github.com/user")
-            resp = yield client.fetch(req)
+            resp = yield fetch(self, req)
             if 200 <= resp.code < 300:
                 return True, None
             else:
                 return False, resp.body.decode('utf-8')
         except HTTPError as e:
+            if e.response is None:
+                return False, e.message
             return False, e.response.reason
 
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
             req = self.get_request("https://api.github.com/user")
-            resp = yield client.fetch(req)
+            resp = yield fetch(self, req)
             resp_data = json.loads(resp.body.decode('utf-8'))
             return resp_data.get('login', 'GitHub Account')
         except Exception:
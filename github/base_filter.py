@@ -2,11 +2,10 @@ import json
 from urllib.parse import urlencode
 from datetime import date as date_type
 
-from tornado.httpclient import AsyncHTTPClient
-
 from vizydrop.sdk.source import SourceFilter
 from vizydrop.fields import *
 from vizydrop.utils import parse_link_header
+from .api import fetch
 
 
 class GitHubRepositoryFilter(SourceFilter):
@@ -17,12 +16,11 @@ class GitHubRepositoryFilter(SourceFilter):
         GET https://api.github.com/user/repos
         Special Accept header required: application/vnd.github.moondragon+json
         """
-        client = AsyncHTTPClient()
         uri = "https://api.github.com/user/repos?per_page=100"
         data = []
         while uri is not None:
             req = account.get_request(uri, headers={"Accept": "application/vnd.github.moondragon+json"})
-            response = yield client.fetch(req)
+            response = yield fetch(account, req)
             response_object = json.loads(response.body.decode('utf-8'))
             data += response_object
             links = parse_link_header(response.headers.get('Link', ''))
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+from tornado.ioloop import IOLoop
+
+# the per-commit stats we keep, in the order they're stored
+STAT_FIELDS = ['date', 'author', 'added_files', 'deleted_files', 'modified_files', 'changed_files', 'additions',
+               'deletions']
+# how many commits' stats do we hold in memory?
+COMMIT_STORE_SIZE = 100000
+# how many commits' stats do we hold on disk? (only if GITHUB_COMMIT_STORE_PATH is set)
+COMMIT_STORE_DISK_SIZE = 1000000
+# how long do we gather up writes before committing them (in seconds)?
+WRITE_DELAY = 1
+# how many writes do we gather up at most?
+WRITE_BATCH = 500
+
+
+class CommitStatsStore(object):
+    """
+    Content-addressed store of per-commit stats, keyed by commit SHA
+
+    Commits never change, so once a commit's details have been fetched we never need to fetch them again.
+    Stats are kept in SQLite; in memory unless a path is given. Writes are gathered up and committed together, and
+    the commits stored longest ago are dropped once we hold more than max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        """
+        :param path: path of the database on disk, or None to keep it in memory
+        :param max_entries: how many commits to hold, defaults to COMMIT_STORE_DISK_SIZE or COMMIT_STORE_SIZE
+        """
+        if max_entries is None:
+            max_entries = COMMIT_STORE_DISK_SIZE if path else COMMIT_STORE_SIZE
+        self.max_entries = max_entries
+        # stats waiting to be written, by sha
+        self._pending = {}
+        self._flush_scheduled = False
+        self._db = sqlite3.connect(path or ':memory:')
+        self._db.execute("CREATE TABLE IF NOT EXISTS commit_stats (sha TEXT PRIMARY KEY, {})".format(
+            ', '.join(STAT_FIELDS)))
+        # stores created before a field was added get the column, empty until the commit is fetched again
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(commit_stats)")]
+        for field in STAT_FIELDS:
+            if field not in columns:
+                self._db.execute("ALTER TABLE commit_stats ADD COLUMN {}".format(field))
+        self._db.commit()
+
+    def get_many(self, shas):
+        """
+        Looks up the stats we hold for a set of commits
+        :param shas: list of commit SHAs
+        :return: dict of sha => stats dict, for the commits we have
+        """
+        ret = {sha: self._pending[sha] for sha in shas if sha in self._pending}
+        shas = [sha for sha in shas if sha not in ret]
+        # stay well under SQLite's limit on query parameters
+        for n in range(0, shas.__len__(), 500):
+            chunk = shas[n:n + 500]
+            rows = self._db.execute("SELECT sha, {} FROM commit_stats WHERE sha IN ({})".format(
+                ', '.join(STAT_FIELDS), ','.join('?' * chunk.__len__())), chunk)
+            for row in rows:
+                if None in row[1:]:
+                    # stored before we kept all of our fields; it needs fetching again
+                    continue
+                ret[row[0]] = dict(zip(STAT_FIELDS, row[1:]))
+        return ret
+
+    def set(self, sha, stats):
+        """
+        Stores a commit's stats
+        :param sha: commit SHA
+        :param stats: dict holding each of STAT_FIELDS
+        """
+        self._pending[sha] = {field: stats[field] for field in STAT_FIELDS}
+        if self._pending.__len__() >= WRITE_BATCH:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().call_later(WRITE_DELAY, self.flush)
+
+    def flush(self):
+        """
+        Writes the stats we've gathered up, in one transaction
+        """
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        self._db.executemany("INSERT OR REPLACE INTO commit_stats (sha, {}) VALUES (?, {})".format(
+            ', '.join(STAT_FIELDS), ', '.join('?' * STAT_FIELDS.__len__())),
+            [[sha] + [stats[field] for field in STAT_FIELDS] for sha, stats in self._pending.items()])
+        self._pending = {}
+        # rows are numbered as they're written, so the lowest numbered were stored longest ago
+        self._db.execute("DELETE FROM commit_stats WHERE rowid <= (SELECT MAX(rowid) FROM commit_stats) - ?",
+                         (self.max_entries, ))
+        self._db.commit()
+
+
+commit_store = CommitStatsStore(os.environ.get('GITHUB_COMMIT_STORE_PATH', None))
@@ -2,12 +2,15 @@ import json
 from datetime import timedelta
 from tornado import gen
 
-from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPError
 from tornado.log import app_log
 
-from tornado.locks import BoundedSemaphore
+from tornado.concurrent import Future
 from tornado.queues import Queue
 
+from common.writer import RowWriter
+from .api import fetch
+from .commit_store import commit_store
 from .base_filter import GitHubRepositoryDateFilter
 from vizydrop.sdk.source import StreamingDataSource, SourceSchema
 from vizydrop.utils import parse_link_header
@@ -18,6 +21,33 @@ from vizydrop.fields import *
 FETCH_CONCURRENCY = 10
 # our maximum request time (in seconds)
 MAXIMUM_REQ_TIME = 30
+# how do we gather commit stats? 'graphql' gets them for 100 commits per request, 'rest' makes a request per commit
+COMMIT_STATS_ENGINE = 'graphql'
+# do we fill in added/deleted/modified file counts? GraphQL doesn't have these, so with the graphql engine they cost
+# a REST request for every commit we don't already hold (False leaves them empty)
+FILE_STATUS_COUNTS = True
+# how many commits can we fetch individually?
+MAXIMUM_COMMIT_FETCHES = 500
+# do we write commits in history order? (otherwise they're written as soon as they're ready)
+PRESERVE_ORDER = True
+
+# a page of the default branch's history, with the stats for each commit
+HISTORY_QUERY = """
+query ($owner: String!, $name: String!, $first: Int!, $after: String, $since: GitTimestamp, $until: GitTimestamp) {
+  repository(owner: $owner, name: $name) {
+    defaultBranchRef {
+      target {
+        ... on Commit {
+          history(first: $first, after: $after, since: $since, until: $until) {
+            pageInfo { hasNextPage endCursor }
+            nodes { oid additions deletions changedFiles author { name date } }
+          }
+        }
+      }
+    }
+  }
+}
+"""
 
 
 class GitHubCommitsSource(StreamingDataSource):
@@ -34,20 +64,81 @@ class GitHubCommitsSource(StreamingDataSource):
         added_files = NumberField(name="Added Files")
         deleted_files = NumberField(name="Deleted Files")
         modified_files = NumberField(name="Modified Files")
+        changed_files = NumberField(name="Changed Files")
         additions = NumberField(name="Code Additions")
         deletions = NumberField(name="Code Deletions")
 
+    @classmethod
+    @gen.coroutine
+    def get_history_page(cls, account, source_filter, first=100, after=None):
+        """
+        Gathers a page of commit history, with stats, from the GH GraphQL API
+        POST https://api.github.com/graphql
+        :param account: account to make the request for
+        :param source_filter: GitHubRepositoryDateFilter
+        :param first: number of commits to get (100 at most)
+        :param after: cursor to continue from, or None for the first page
+        :return: tuple of (list of commits, cursor for the next page or None)
+        """
+        owner, name = source_filter.repository.split('/', 1)
+        variables = {"owner": owner, "name": name, "first": first, "after": after}
+        variables.update(source_filter.get_qs(encode=False))
+        req = account.get_request("https://api.github.com/graphql", method='POST',
+                                  body=json.dumps({"query": HISTORY_QUERY, "variables": variables}),
+                                  headers={"Content-Type": "application/json"})
+        response = yield fetch(account, req)
+        response_data = json.loads(response.body.decode('utf-8'))
+        if response_data.get('errors', None):
+            # GraphQL errors come back with a 200
+            raise HTTPError(502, response_data['errors'][0].get('message', 'GraphQL query failed'))
+        branch = (response_data['data']['repository'] or {}).get('defaultBranchRef', None)
+        if branch is None or branch['target'] is None:
+            # nothing's been pushed yet
+            return [], None
+        history = branch['target']['history']
+        cursor = history['pageInfo']['endCursor'] if history['pageInfo']['hasNextPage'] else None
+        return history['nodes'], cursor
+
+    @classmethod
+    @gen.coroutine
+    def get_commit_stats(cls, account, url):
+        """
+        Gathers a single commit's stats from the GH REST API, and stores them
+        GET https://api.github.com/repos/:owner/:repo/commits/:sha
+        :param account: account to make the request for
+        :param url: API URL of the commit
+        :return: dict of the commit's stats
+        """
+        req = account.get_request(url)
+        response = yield fetch(account, req)
+        response_data = json.loads(response.body.decode('utf-8'))
+        obj = {
+            'date': response_data['commit']['author']['date'],
+            'author': response_data['commit']['author']['name'],
+            'added_files': [file for file in response_data['files'] if file['status'] == 'added'].__len__(),
+            'deleted_files': [file for file in response_data['files'] if file['status'] == 'deleted'].__len__(),
+            'modified_files': [file for file in response_data['files'] if file['status'] == 'modified'].__len__(),
+            'changed_files': response_data['files'].__len__(),
+            'additions': response_data['stats']['additions'],
+            'deletions': response_data['stats']['deletions']
+        }
+        commit_store.set(response_data['sha'], obj)
+        return obj
+
     @classmethod
     @gen.coroutine
     def get_data(cls, account, source_filter, limit=100, skip=0):
         """
         Gathers commit information from GH
-        GET https://api.github.com/repos/:owner/:repo/commits
+        POST https://api.github.com/graphql
+        or GET https://api.github.com/repos/:owner/:repo/commits
         Header: Accept: application/vnd.github.v3+json
+
+        Commit lists are paged through by a producer, which hands each commit to a bounded pool of consumers as
+        soon as its page arrives; the consumers fetch whatever stats we don't already have.
         """
         if not account or not account.enabled:
             raise ValueError('cannot gather information without a valid account')
-        client = AsyncHTTPClient()
 
         source_filter = GitHubRepositoryDateFilter(source_filter)
 
@@ -55,96 +146,154 @@ class GitHubCommitsSource(StreamingDataSource):
             raise ValueError('required parameter projects missing')
 
         default_headers = {"Content-Type": "application/json", "Accept": "application/vnd.github.v3+json"}
+        app_log.info("Starting retrieval of commits for account {}".format(account._id))
 
-        # first we grab our list of commits
-        uri = "https://api.github.com/repos/{}/commits".format(source_filter.repository)
-        qs = source_filter.get_qs()
-        if qs != '':
-            uri = uri + '?' + qs
-        app_log.info("Starting retrieval of commit list for account {}".format(account._id))
-        if limit is not None and limit <= 100:
-            # we can handle our limit right here
-            uri += "?per_page={}".format(limit)
-        elif limit is None:
-            uri += "?per_page=100"  # maximum number per page for GitHub API
-        taken = 0
-
-        queue = Queue()
-        sem = BoundedSemaphore(FETCH_CONCURRENCY)
-        done, working = set(), set()
-
-        while uri is not None:
-            app_log.info(
-                "({}) Retrieving next page, received {} commits thus far".format(account._id, taken))
-            req = account.get_request(uri, headers=default_headers)
-            response = yield client.fetch(req)
-
-            page_data = json.loads(response.body.decode('utf-8'))
-            taken += page_data.__len__()
-            for item in page_data:
-                queue.put(item.get('url', None))
-
-            if limit is None or taken < limit:
-                # parse the Link header from GitHub (https://developer.github.com/v3/#pagination)
-                links = parse_link_header(response.headers.get('Link', ''))
-                uri = links.get('next', None)
-            else:
-                break
-
-            if queue.qsize() > 500:
-                raise HTTPError(413, 'too many commits')
-        app_log.info("({}) Commit list retrieved, fetching info for {} commits".format(account._id, taken))
+        # our pipeline: entries of (index, stats or None, url), and None once there's nothing more to do
+        queue = Queue(maxsize=FETCH_CONCURRENCY * 2)
+        finished = Future()
+        cancelled = False
+        running = 0
+        # commits that are ready ahead of their turn, by index
+        held = {}
+        next_index = 0
+        writer = RowWriter(cls.write)
 
-        # open our list
-        cls.write('[')
+        def deliver(index, row):
+            nonlocal next_index
+            if cancelled:
+                # our list is already closed
+                return
+            if not PRESERVE_ORDER:
+                writer.write_row(row)
+                return
+            held[index] = row
+            while next_index in held:
+                writer.write_row(held.pop(next_index))
+                next_index += 1
+
+        def cancel():
+            nonlocal cancelled
+            cancelled = True
+            # empty the queue (which releases a blocked producer), then wake any idle consumers
+            while queue.qsize() > 0:
+                queue.get_nowait()
+            for n in range(FETCH_CONCURRENCY):
+                queue.put_nowait(None)
 
-        # our worker to actually fetch the info
         @gen.coroutine
-        def fetch_url():
-            current_url = yield queue.get()
-            try:
-                if current_url in working:
+        def produce():
+            index, taken, fetches = 0, 0, 0
+            cursor = None
+            uri = None
+            if COMMIT_STATS_ENGINE != 'graphql':
+                uri = "https://api.github.com/repos/{}/commits".format(source_filter.repository)
+                qs = source_filter.get_qs()
+                if limit is not None and limit <= 100:
+                    # we can handle our limit right here
+                    qs = "per_page={}&{}".format(limit, qs)
+                elif limit is None:
+                    qs = "per_page=100&{}".format(qs)  # maximum number per page for GitHub API
+                uri = uri + '?' + qs.rstrip('&') if qs != '' else uri
+
+            while not cancelled:
+                app_log.info(
+                    "({}) Retrieving next page of commits, received {} commits thus far".format(account._id, taken))
+                if COMMIT_STATS_ENGINE == 'graphql':
+                    first = 100 if limit is None else min(limit - taken, 100)
+                    nodes, cursor = yield cls.get_history_page(account, source_filter, first, cursor)
+                    commits = []
+                    for node in nodes:
+                        url = "https://api.github.com/repos/{}/commits/{}".format(source_filter.repository,
+                                                                                  node['oid'])
+                        stats = None
+                        if not FILE_STATUS_COUNTS:
+                            stats = {
+                                'date': node['author']['date'],
+                                'author': node['author']['name'],
+                                'added_files': None,
+                                'deleted_files': None,
+                                'modified_files': None,
+                                'changed_files': node['changedFiles'],
+                                'additions': node['additions'],
+                                'deletions': node['deletions']
+                            }
+                        commits.append((node['oid'], url, stats))
+                    more = cursor is not None
+                else:
+                    req = account.get_request(uri, headers=default_headers)
+                    response = yield fetch(account, req)
+                    page_data = json.loads(response.body.decode('utf-8'))
+                    commits = [(item['sha'], item.get('url', None), None) for item in page_data]
+                    # parse the Link header from GitHub (https://developer.github.com/v3/#pagination)
+                    links = parse_link_header(response.headers.get('Link', ''))
+                    uri = links.get('next', None)
+                    more = uri is not None
+                taken += commits.__len__()
+
+                # commits we already hold the stats for don't need fetching again
+                stored_stats = commit_store.get_many([sha for sha, url, stats in commits if stats is None])
+                for sha, url, stats in commits:
+                    if stats is None:
+                        stats = stored_stats.get(sha, None)
+                    if stats is None:
+                        fetches += 1
+                        if fetches > MAXIMUM_COMMIT_FETCHES:
+                            raise HTTPError(413, 'too many commits')
+                    yield queue.put((index, stats, url))
+                    if cancelled:
+                        return
+                    index += 1
+
+                if not more or (limit is not None and taken >= limit):
+                    break
+            app_log.info("({}) Commit list retrieved, {} commits, {} to fetch".format(account._id, taken, fetches))
+            for n in range(FETCH_CONCURRENCY):
+                if cancelled:
                     return
-                page_no = working.__len__()
-                app_log.info("Fetching page {}".format(page_no))
-                working.add(current_url)
-                req = account.get_request(current_url)
-                client = AsyncHTTPClient()
-                response = yield client.fetch(req)
-                response_data = json.loads(response.body.decode('utf-8'))
-                obj = {
-                    'date': response_data['commit']['author']['date'],
-                    'author': response_data['commit']['author']['name'],
-                    'added_files': [file for file in response_data['files'] if file['status'] == 'added'].__len__(),
-                    'deleted_files': [file for file in response_data['files'] if file['status'] == 'deleted'].__len__(),
-                    'modified_files': [file for file in response_data['files'] if file['status'] == 'modified'].__len__(),
-                    'additions': response_data['stats']['additions'],
-                    'deletions': response_data['stats']['deletions']
-                }
-                if done.__len__() > 0:
-                    cls.write(',')
-                cls.write(json.dumps(obj))
-                done.add(current_url)
-                app_log.info("Page {} downloaded".format(page_no))
-
-            finally:
-                queue.task_done()
-                sem.release()
+                yield queue.put(None)
 
         @gen.coroutine
-        def worker():
-            while True:
-                yield sem.acquire()
-                fetch_url()
+        def consume():
+            while not cancelled:
+                entry = yield queue.get()
+                if entry is None:
+                    break
+                index, stats, url = entry
+                if stats is None:
+                    stats = yield cls.get_commit_stats(account, url)
+                deliver(index, stats)
 
-        # start our concurrency worker
-        worker()
+        def task_done(future):
+            nonlocal running
+            running -= 1
+            error = future.exception()
+            if finished.done() or cancelled:
+                return
+            if error is not None:
+                finished.set_exc_info(future.exc_info())
+            elif running == 0:
+                finished.set_result(None)
+
+        # open our list
+        writer.open()
+        tasks = [produce()] + [consume() for n in range(FETCH_CONCURRENCY)]
+        running = tasks.__len__()
+        for task in tasks:
+            task.add_done_callback(task_done)
         try:
-            # wait until we're done
-            yield queue.join(timeout=timedelta(seconds=MAXIMUM_REQ_TIME))
+            # wait until we're done, or something goes wrong
+            yield gen.with_timeout(timedelta(seconds=MAXIMUM_REQ_TIME), finished)
         except gen.TimeoutError:
             app_log.warning("Request exceeds maximum time, cutting response short")
+        except Exception as err:
+            if not writer.started:
+                # nothing has gone out yet, so we can still respond with the error
+                raise
+            # we've already responded, all we can do is finish our list
+            app_log.warning("Error retrieving commits after output began, cutting response short: {}".format(err))
         finally:
-            # close our list
-            cls.write(']')
+            # stop our producer and consumers; anything still in flight is dropped
+            cancel()
+        # close our list
+        writer.close()
         app_log.info("Finished retrieving commits for {}".format(account._id))
@@ -1,14 +1,38 @@
+from bisect import bisect_left, bisect_right
 import json
+from datetime import date as date_type, timedelta
+import time
 from tornado import gen
 
-from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPError
 
 from tornado.log import app_log
 
+from common.cache import LRUCache
+from common.writer import RowWriter
+from .api import fetch
 from .base_filter import GitHubRepositoryDateFilter
 from vizydrop.sdk.source import StreamingDataSource, SourceSchema
 from vizydrop.fields import *
 
+# how long are a repository's stats good for (in seconds) before we check for new ones?
+STATS_TTL = 3600
+# how many repositories' stats do we hold on to?
+STATS_CACHE_SIZE = 200
+# how long do we wait between polls while GitHub compiles stats (in seconds)?
+STATS_POLL_INTERVAL = 5
+# how many times do we poll before giving up?
+STATS_POLL_ATTEMPTS = 24
+# how long can a request wait on stats we don't have yet (in seconds)?
+STATS_WAIT = 10
+# a row of our output, exactly as json.dumps would write it
+ROW_FORMAT = '{{"date": "{}", "author": {}, "additions": {}, "deletions": {}, "commits": {}}}'
+
+# compiled stats by (account credentials, repository), along with when we got them
+contributor_stats = LRUCache(max_entries=STATS_CACHE_SIZE)
+# polls in progress, by the same key
+polls = {}
+
 
 class GitHubContributorsStatsSource(StreamingDataSource):
     class Meta:
@@ -25,92 +49,152 @@ class GitHubContributorsStatsSource(StreamingDataSource):
         deletions = NumberField(name="Code Deletions")
         commits = NumberField(name="Number of Commits")
 
+    @staticmethod
+    def compile_stats(data):
+        """
+        Compiles GitHub's contributor stats into columns, with everything we write worked out up front
+        :param data: list of contributors from GitHub
+        :return: list of dicts, one per contributor, holding the author and a column for each week value (in order)
+        """
+        contributors = []
+        for user_data in data:
+            weeks = sorted(user_data.get('weeks', []), key=lambda week: week['w'])
+            contributors.append({
+                'author': json.dumps(user_data['author']['login']),
+                # week data is a Unix timestamp
+                'w': [week['w'] for week in weeks],
+                'date': [datetime.fromtimestamp(week['w']).isoformat() for week in weeks],
+                'a': [week['a'] for week in weeks],
+                'd': [week['d'] for week in weeks],
+                'c': [week['c'] for week in weeks]
+            })
+        return contributors
+
+    @staticmethod
+    def get_filter_bounds(value):
+        """
+        Works out a date filter as bounds we can compare week timestamps against
+        :param value: filter date; either a dict with _min and/or _max, or a date weeks must fall on or after
+        :return: tuple of (minimum, maximum) Unix timestamps, either of which may be None
+        """
+        def to_timestamp(bound):
+            # our dates usually come in as strings
+            if isinstance(bound, str):
+                try:
+                    bound = datetime.strptime(bound, '%Y-%m-%d')
+                except ValueError:
+                    return None
+            if isinstance(bound, datetime):
+                return bound.timestamp()
+            if isinstance(bound, date_type):
+                return datetime(bound.year, bound.month, bound.day).timestamp()
+            return None
+
+        if isinstance(value, dict):
+            return to_timestamp(value.get('_min', None)), to_timestamp(value.get('_max', None))
+        return to_timestamp(value), None
+
+    @classmethod
+    @gen.coroutine
+    def poll_stats(cls, account, repository):
+        """
+        Polls GitHub for a repository's contributor stats until they've been compiled, and caches them
+        GET https://api.github.com/repos/:owner/:repo/stats/contributors
+        :param account: account to make the requests for
+        :param repository: repository, as owner/repo
+        :return: compiled stats, or None if GitHub didn't get them done in time
+        """
+        url = "https://api.github.com/repos/{}/stats/contributors".format(repository)
+        for i in range(0, STATS_POLL_ATTEMPTS):
+            resp = yield fetch(account, account.get_request(url))
+            if resp.code == 202:
+                # GitHub is making this in the background, let's wait a little and retry
+                app_log.info("GitHub responded 202: waiting for stats to compile for {}".format(repository))
+                yield gen.sleep(STATS_POLL_INTERVAL)
+                continue
+            # an empty repository has no stats at all
+            data = json.loads(resp.body.decode('utf-8')) if resp.body else []
+            stats = cls.compile_stats(data)
+            contributor_stats.set((account.credential_key, repository), (time.time(), stats))
+            app_log.info("Contribution data received for {}".format(repository))
+            return stats
+        app_log.warning("GitHub didn't compile contribution data for {} in time".format(repository))
+        return None
+
+    @classmethod
+    def start_poll(cls, account, repository):
+        """
+        Starts polling for a repository's contributor stats in the background, unless we already are
+        :return: Future resolving to the compiled stats
+        """
+        key = (account.credential_key, repository)
+        poll = polls.get(key, None)
+        if poll is None:
+            poll = cls.poll_stats(account, repository)
+            polls[key] = poll
+
+            def finished(future):
+                polls.pop(key, None)
+                if future.exception() is not None:
+                    app_log.warning("Failed to poll contribution data for {}: {}".format(repository,
+                                                                                         future.exception()))
+
+            poll.add_done_callback(finished)
+        return poll
+
     @classmethod
     @gen.coroutine
     def get_data(cls, account, source_filter, limit=100, skip=0):
         """
-        Gathers commit information from GH
-        GET https://api.github.com/repos/:owner/:repo/commits
+        Gathers weekly contribution information from GH
+        GET https://api.github.com/repos/:owner/:repo/stats/contributors
         Header: Accept: application/vnd.github.v3+json
+
+        GitHub compiles these stats in the background, so they're polled for off the request path and cached;
+        we answer from the cache whenever we can.
         """
         if not account or not account.enabled:
             raise ValueError('cannot gather information without a valid account')
-        client = AsyncHTTPClient()
 
         source_filter = GitHubRepositoryDateFilter(source_filter)
 
         if source_filter.repository is None:
             raise ValueError('required parameter projects missing')
 
-        data = None
-
-        req = account.get_request("https://api.github.com/repos/{}/stats/contributors".format(source_filter.repository))
         app_log.info("Starting retrieval of weekly contribution data for account {}".format(account._id))
-        for i in range(0, 3):  # we only try this four times at most
-            resp = yield client.fetch(req)
-            if (resp.code == 202):
-                # GitHub is making this in the background, let's wait a little and retry
-                app_log.info("GitHub responded 202: waiting for stats to compile for account {}".format(account._id))
-                yield gen.sleep(5)
-            else:
-                data = json.loads(resp.body.decode('utf-8'))
-                app_log.info("Data received for weekly contribution")
-                break
-
-        # if we didn't get anything from GitHub, we fail out
-        if not data:
-            app_log.warning("No contribution data received from GitHub for account {}".format(account._id))
-            raise HTTPError(408, "request timed out: please try again later")
+        cached = contributor_stats.get((account.credential_key, source_filter.repository))
+        if cached is not None:
+            fetched, stats = cached
+            if time.time() - fetched > STATS_TTL:
+                # answer with what we have, and check for new stats in the background
+                cls.start_poll(account, source_filter.repository)
+        else:
+            poll = cls.start_poll(account, source_filter.repository)
+            try:
+                stats = yield gen.with_timeout(timedelta(seconds=STATS_WAIT), poll, quiet_exceptions=Exception)
+            except gen.TimeoutError:
+                # we'll keep polling, so they'll be ready for next time
+                stats = None
+
+            # if we didn't get anything from GitHub, we fail out
+            if stats is None:
+                app_log.warning("No contribution data received from GitHub for account {}".format(account._id))
+                raise HTTPError(408, "request timed out: please try again later")
 
         # open our list
-        cls.write('[')
-        count = 0
-        # bring up our min/max filters if we have them
-        if isinstance(source_filter.date, dict):
-            filter_min = source_filter.date.get('_min', None)
-            filter_max = source_filter.date.get('_max', None)
-            if filter_min is not None:
-                try:
-                    filter_min = datetime.strptime(filter_min, '%Y-%m-%d')
-                except ValueError:
-                    pass
-            if filter_max is not None:
-                try:
-                    filter_max = datetime.strptime(filter_max, '%Y-%m-%d')
-                except ValueError:
-                    pass
-        # otherwise, our dates come in as strings, so we need to parse that
-        elif isinstance(source_filter.date, str):
-            try:
-                source_filter.date = datetime.strptime(source_filter.date, '%Y-%m-%d')
-            except ValueError:
-                pass
-        for user_data in data:
-            # and parse through our weeks
-            for week in user_data.get('weeks', []):
-                weekdate = datetime.fromtimestamp(week['w'])
-                if source_filter.date is not None:
-                    # check for filtered date
-                    if filter_min is not None and filter_min > weekdate:
-                        continue
-                    if filter_max is not None and filter_max < weekdate:
-                        continue
-                    if isinstance(source_filter.date, datetime) and source_filter.date > weekdate:
-                        continue
-                obj = {
-                    # week data is a Unix timestamp
-                    'date': weekdate.isoformat(),
-                    # and our user
-                    'author': user_data['author']['login'],
-                    # and our commit data
-                    'additions': week['a'],
-                    'deletions': week['d'],
-                    'commits': week['c']
-                }
-                if count > 0:
-                    cls.write(',')
-                cls.write(json.dumps(obj))
-                count += 1
+        writer = RowWriter(cls.write)
+        writer.open()
+        # our filter, as Unix timestamps we can compare weeks against
+        filter_min, filter_max = cls.get_filter_bounds(source_filter.date)
+        for contributor in stats:
+            author, weeks, dates = contributor['author'], contributor['w'], contributor['date']
+            additions, deletions, commits = contributor['a'], contributor['d'], contributor['c']
+            # weeks are sorted, so we can skip straight to the ones in range
+            start = 0 if filter_min is None else bisect_left(weeks, filter_min)
+            end = weeks.__len__() if filter_max is None else bisect_right(weeks, filter_max)
+            for index in range(start, end):
+                writer.write_encoded(ROW_FORMAT.format(dates[index], author, additions[index], deletions[index],
+                                                       commits[index]))
         # close our list
-        cls.write(']')
-        app_log.info("Finished retrieving {} contribution data for {}".format(count, account._id))
+        writer.close()
+        app_log.info("Finished retrieving {} contribution data for {}".format(writer.count, account._id))
@@ -2,27 +2,36 @@ from urllib.parse import urlencode
 import json
 from tornado import gen
 
-from tornado.httpclient import AsyncHTTPClient
 
 from tornado.log import app_log
 
+from common.cache import LRUCache
+from common.writer import RowWriter
+from .api import fetch
 from .base_filter import GitHubRepositoryDateFilter
 from vizydrop.utils import parse_link_header
 from vizydrop.fields import *
 from vizydrop.sdk.source import SourceSchema, StreamingDataSource
 
+# how long an incremental snapshot is used before we do a full refresh (in seconds)
+SNAPSHOT_TTL = 3600
+# how many incremental snapshots do we hold on to?
+SNAPSHOT_CACHE_SIZE = 50
+
+# incremental sync snapshots, keyed by (account credentials, repository, filter)
+snapshots = LRUCache(max_entries=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_TTL)
+
 
 class GitHubIssuesFilter(GitHubRepositoryDateFilter):
     def get_milestone_options(account, repository, **kwargs):
         """
         Gathers milestone options for a GitHub repository
         """
-        client = AsyncHTTPClient()
         uri = "https://api.github.com/repos/{}/milestones?page_size=100".format(repository)
         data = []
         while uri is not None:
             req = account.get_request(uri)
-            response = yield client.fetch(req)
+            response = yield fetch(account, req)
             response_object = json.loads(response.body.decode('utf-8'))
             data += response_object
             links = parse_link_header(response.headers.get('Link', ''))
@@ -70,17 +79,37 @@ class GitHubIssuesSource(StreamingDataSource):
         assignee = TextField(name="Name of the assignee", response_loc="assignee-login")
         milestone = TextField(name="Milestone name", response_loc="milestone-title")
 
+    # should we only fetch issues updated since our last sync?
+    incremental_sync = True
+
+    @staticmethod
+    def matches_filter(issue, filter_elements):
+        """
+        Checks whether an issue still belongs in our results; issues can change state or milestone
+        :param issue: issue from the GitHub API
+        :param filter_elements: our filter's query string elements
+        :return: bool
+        """
+        # GitHub only lists open issues unless told otherwise
+        state = filter_elements.get('state', 'open')
+        if state != 'all' and issue['state'] != state:
+            return False
+        if 'milestone' in filter_elements:
+            return issue['milestone'] is not None and issue['milestone']['number'] == int(filter_elements['milestone'])
+        return True
+
     @classmethod
     @gen.coroutine
     def get_data(cls, account, source_filter, limit=100, skip=0):
         """
-        Gathers commit information from GH
-        GET https://api.github.com/repos/:owner/:repo/commits
+        Gathers issue information from GH
+        GET https://api.github.com/repos/:owner/:repo/issues
         Header: Accept: application/vnd.github.v3+json
+
+        Full exports keep a snapshot of the issues; until it expires, refreshes only fetch issues updated since.
         """
         if not account or not account.enabled:
             raise ValueError('cannot gather information without a valid account')
-        client = AsyncHTTPClient()
 
         source_filter = GitHubIssuesFilter(source_filter)
 
@@ -93,34 +122,71 @@ class GitHubIssuesSource(StreamingDataSource):
         page_size = limit if limit is not None and limit <= 100 else 100
         taken = 0
 
-        uri = "https://api.github.com/repos/{}/issues?per_page={}&{}".format(source_filter.repository,
-                                                                             page_size, source_filter.get_qs())
-        uri = uri.rstrip('&')  # remove trailing & in case filter has no QS elements
+        # incremental syncs are only done for full exports
+        filter_elements = source_filter.get_qs(encode=False)
+        incremental = cls.incremental_sync and limit is None and skip == 0
+        snapshot_key = (account.credential_key, source_filter.repository, urlencode(sorted(filter_elements.items())))
+        snapshot = snapshots.get(snapshot_key) if incremental else None
+
+        if snapshot is not None:
+            # we only need the issues updated since our last sync; issues can leave our filter by changing state or
+            # milestone, so we ask for every change and match them ourselves
+            app_log.info("Incremental retrieval of issues updated since {}".format(snapshot['watermark']))
+            query = dict(filter_elements, state='all', since=snapshot['watermark'], sort='updated')
+            query.pop('milestone', None)
+            uri = "https://api.github.com/repos/{}/issues?per_page={}&{}".format(source_filter.repository,
+                                                                                 page_size, urlencode(query))
+        else:
+            uri = "https://api.github.com/repos/{}/issues?per_page={}&{}".format(source_filter.repository,
+                                                                                 page_size, source_filter.get_qs())
+            uri = uri.rstrip('&')  # remove trailing & in case filter has no QS elements
+
+        # our snapshot's rows keyed by issue number, and the latest update we've seen
+        rows = snapshot['rows'] if snapshot is not None else {}
+        watermark = None
 
-        cls.write('[')
-        count = 0
+        writer = RowWriter(cls.write)
+        writer.open()
 
         while uri is not None:
             app_log.info(
                 "({}) Retrieving next page, received {} issues thus far".format(account._id, taken))
             req = account.get_request(uri, headers=default_headers)
-            response = yield client.fetch(req)
+            response = yield fetch(account, req)
 
             page_data = json.loads(response.body.decode('utf-8'))
 
             for issue in page_data:
-                if count > 0:
-                    cls.write(',')
-                cls.write(cls.format_data_to_schema(issue))
-                count += 1
-
-            if limit is None or count < limit:
+                if incremental and (watermark is None or issue['updated_at'] > watermark):
+                    watermark = issue['updated_at']
+                if snapshot is not None:
+                    # changes are merged into our snapshot, which is streamed once we're done
+                    if cls.matches_filter(issue, filter_elements):
+                        rows[issue['number']] = cls.format_data_to_schema(issue)
+                    else:
+                        rows.pop(issue['number'], None)
+                    continue
+                formatted = cls.format_data_to_schema(issue)
+                if incremental:
+                    rows[issue['number']] = formatted
+                writer.write_row(formatted)
+
+            if limit is None or writer.count < limit:
                 # parse the Link header from GitHub (https://developer.github.com/v3/#pagination)
                 links = parse_link_header(response.headers.get('Link', ''))
                 uri = links.get('next', None)
             else:
                 break
 
-        cls.write(']')
+        if snapshot is not None:
+            # newest issues first, as GitHub lists them
+            for number in sorted(rows, reverse=True):
+                writer.write_row(rows[number])
+            if watermark is not None:
+                snapshot['watermark'] = watermark
+        elif incremental and watermark is not None:
+            snapshots.set(snapshot_key, {'watermark': watermark, 'rows': rows})
+
+        writer.close()
 
-        app_log.info("[GitHub] Finished retrieving {} issues for repository {}".format(count, source_filter.repository))
+        app_log.info("[GitHub] Finished retrieving {} issues for repository {}".format(writer.count, source_filter.repository))
@@ -0,0 +1,132 @@
+from io import BytesIO
+from unittest import mock
+import unittest
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPRequest, HTTPResponse, HTTPError
+from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
+
+from github.api import RateLimitGovernor, MAXIMUM_RATE_LIMIT_WAIT
+
+TOKEN = 'token'
+NOW = 1500000000
+
+
+def rate_limited_response(code, remaining, reset):
+    headers = HTTPHeaders({'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(reset),
+                           'X-RateLimit-Resource': 'core'})
+    return HTTPResponse(HTTPRequest('https://api.github.com/repos/o/r/commits'), code, headers=headers,
+                        buffer=BytesIO(b''))
+
+
+class RateLimitGovernorTests(unittest.TestCase):
+    def setUp(self):
+        # time stands still, and waits are recorded rather than slept through
+        self.waits = []
+        time_patch = mock.patch('github.api.time.time', lambda: NOW)
+        sleep_patch = mock.patch('github.api.gen.sleep', self.sleep)
+        time_patch.start()
+        sleep_patch.start()
+        self.addCleanup(time_patch.stop)
+        self.addCleanup(sleep_patch.stop)
+        self.governor = RateLimitGovernor()
+
+    def sleep(self, delay):
+        self.waits.append(delay)
+        # let the other callers have a turn
+        future = Future()
+        IOLoop.current().add_callback(future.set_result, None)
+        return future
+
+    def set_budget(self, remaining, reset):
+        self.governor.reserve(TOKEN)
+        self.governor.update(TOKEN, rate_limited_response(200, remaining, reset))
+
+    def run_callers(self, callers, requests, remaining, reset):
+        """
+        Runs a number of concurrent callers through the governor, each making a number of requests
+        :return: list of HTTPErrors raised
+        """
+        errors = []
+        counter = {'remaining': remaining}
+
+        @gen.coroutine
+        def caller():
+            for n in range(requests):
+                try:
+                    yield self.governor.acquire(TOKEN)
+                except HTTPError as err:
+                    errors.append(err)
+                    continue
+                counter['remaining'] -= 1
+                self.governor.update(TOKEN, rate_limited_response(200, counter['remaining'], reset))
+
+        IOLoop.current().run_sync(lambda: gen.multi_future([caller() for n in range(callers)]))
+        return errors
+
+    def test_paced_not_failed(self):
+        # 400 left with 50 minutes to go is about 7.5 seconds a request, far more than MAXIMUM_RATE_LIMIT_WAIT
+        # for most of these
+        reset = NOW + 3000
+        self.set_budget(400, reset)
+        errors = self.run_callers(10, 12, 400, reset)
+        self.assertEqual(errors, [])
+        # all but the first request wait their turn
+        self.assertEqual(self.waits.__len__(), 119)
+        self.assertGreater(max(self.waits), MAXIMUM_RATE_LIMIT_WAIT)
+        # the requests are spread out, rather than all let through at once
+        waits = sorted(self.waits)
+        for wait, next_wait in zip(waits, waits[1:]):
+            self.assertGreater(next_wait - wait, 7)
+        self.assertLess(waits[-1], reset - NOW)
+        self.assertEqual(self.governor._get_budget(TOKEN, 'core')['in_flight'], 0)
+
+    def test_enough_budget(self):
+        reset = NOW + 3000
+        self.set_budget(4000, reset)
+        errors = self.run_callers(10, 12, 4000, reset)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.waits, [])
+
+    def test_exhausted(self):
+        # nothing left and a reset far off: fail fast rather than wait it out
+        reset = NOW + 3000
+        self.set_budget(0, reset)
+        errors = self.run_callers(10, 2, 0, reset)
+        self.assertEqual(errors.__len__(), 20)
+        self.assertEqual(errors[0].code, 403)
+        budget = self.governor._get_budget(TOKEN, 'core')
+        self.assertEqual(budget['in_flight'], 0)
+        self.assertEqual(budget['next_slot'], 0)
+
+    def test_reserved_budget_runs_out(self):
+        # once everything that's left has been handed out, further requests wait on the reset
+        reset = NOW + 3000
+        self.set_budget(3, reset)
+        delays = [self.governor.reserve(TOKEN)[0] for n in range(4)]
+        self.assertEqual(delays[-1], reset - NOW)
+        with self.assertRaises(HTTPError):
+            IOLoop.current().run_sync(lambda: self.governor.acquire(TOKEN))
+
+    def test_abandoned_reservation_gives_back_its_slot(self):
+        reset = NOW + 3000
+        self.set_budget(400, reset)
+        first_delay, first_interval = self.governor.reserve(TOKEN)
+        delay, interval = self.governor.reserve(TOKEN)
+        self.governor.release(TOKEN, interval=interval)
+        # rejected or failed requests don't push everyone after them further out
+        for n in range(20):
+            next_delay, next_interval = self.governor.reserve(TOKEN)
+            self.assertEqual(next_delay, delay)
+            self.governor.release(TOKEN, interval=next_interval)
+        self.assertEqual(self.governor._get_budget(TOKEN, 'core')['in_flight'], 1)
+
+    def test_resources_paced_separately(self):
+        reset = NOW + 3000
+        self.set_budget(400, reset)
+        self.governor.reserve(TOKEN, 'graphql')
+        self.governor.update(TOKEN, rate_limited_response(200, 5000, reset), 'graphql')
+        self.governor.reserve(TOKEN)
+        self.assertEqual(self.governor.reserve(TOKEN, 'graphql'), (0, 0))
@@ -6,7 +6,8 @@ from tornado import gen, log
 import os
 from oauthlib.oauth2.rfc6749.clients.base import AUTH_HEADER
 
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 from tornado.httpclient import HTTPError as AsyncHTTPError
 
 from vizydrop.fields import *
@@ -56,7 +57,7 @@ class GoogleSheetsOAuth(AppOAuthv2Account):
     def validate(self):
         try:
             yield self.do_token_refresh()
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://spreadsheets.google.com/feeds/spreadsheets/private/full")
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
@@ -69,7 +70,7 @@ class GoogleSheetsOAuth(AppOAuthv2Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://www.googleapis.com/oauth2/v1/userinfo?alt=json")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
@@ -3,7 +3,8 @@ import re
 from datetime import timedelta
 
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 from tornado.locks import Condition
 from tornado.log import app_log
 from vizydrop.sdk.source import SourceFilter, SourceSchema, StreamingDataSource
@@ -16,7 +17,7 @@ MAXIMUM_REQ_TIME = 30
 
 class GoogleSheetSourceFilter(SourceFilter):
     def get_spreadsheet_list(account, **kwargs):
-        client = AsyncHTTPClient()
+        client = get_http_client()
         req = account.get_request("https://spreadsheets.google.com/feeds/spreadsheets/private/full")
         response = yield client.fetch(req)
         response_object = json.loads(response.body.decode('utf-8'))
@@ -28,7 +29,7 @@ class GoogleSheetSourceFilter(SourceFilter):
     def get_worksheet_list(account, spreadsheet, **kwargs):
         if not spreadsheet:
             raise ValueError('spreadsheet ID required to gather list')
-        client = AsyncHTTPClient()
+        client = get_http_client()
         req = account.get_request(
             "https://spreadsheets.google.com/feeds/worksheets/{}/private/full".format(spreadsheet))
         response = yield client.fetch(req)
@@ -68,7 +69,7 @@ class GoogleSheetSource(StreamingDataSource):
         """
         if not account or not account.enabled:
             raise ValueError('cannot gather information without an account')
-        client = AsyncHTTPClient()
+        client = get_http_client()
 
         if source_filter.spreadsheet is None:
             raise ValueError('required parameter spreadsheet missing')
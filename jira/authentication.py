@@ -1,4 +1,6 @@
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPRequest, HTTPError
+from common.cache import get_credential_key
+from common.http import get_http_client
 from tornado import gen
 
 from vizydrop.fields import URLField
@@ -19,12 +21,19 @@ class JIRABasicAuth(AppHTTPBasicAuthAccount):
         headers['Authorization'] = "Basic {}".format(self._get_basic_auth())
         return HTTPRequest(url, headers=headers, **kwargs)
 
+    @property
+    def credential_key(self):
+        """
+        Key for caching what this account can see
+        """
+        return get_credential_key(self.username, self.password)
+
     @gen.coroutine
     def validate(self):
         if self.jira_url is None:
             return False, 'missing JIRA url'
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             jira_url = self.jira_url
             req = self.get_request("{}/rest/api/2/myself".format(jira_url.rstrip('/')))
             resp = yield client.fetch(req)
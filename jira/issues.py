@@ -1,43 +1,82 @@
+from collections import OrderedDict, deque
+from datetime import timedelta
+from itertools import islice
 import json
 
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient
+from common.cache import LRUCache
+from common.http import get_http_client
+from common.jsonstream import StreamedPage
+from common.writer import RowWriter
+from .metadata import get_projects, get_issue_types, get_project_statuses
 from tornado.log import app_log
 from vizydrop.sdk.source import StreamingDataSource, SourceSchema, SourceFilter
 from vizydrop.fields import *
 
+# how many search pages can we have in flight at once?
+FETCH_CONCURRENCY = 5
+# past how many issues do we split a full export into windows of creation date? (None to never)
+SHARD_THRESHOLD = 20000
+# roughly how many issues should each window hold?
+SHARD_SIZE = 5000
+# how many windows can we search at once?
+SHARD_CONCURRENCY = 4
+# the narrowest window we'll split
+MIN_SHARD_SPAN = timedelta(minutes=1)
+# how long an incremental snapshot is used before we do a full refresh (in seconds)
+SNAPSHOT_TTL = 3600
+# how many incremental snapshots do we hold on to?
+SNAPSHOT_CACHE_SIZE = 50
+# how far before our watermark does a refresh look? JQL dates only go down to the minute, and are read in the user's
+# timezone rather than whichever one JIRA formatted the watermark in
+WATERMARK_OVERLAP = timedelta(days=1)
+# every how many incremental refreshes do we check for deleted issues? (None to never)
+RECONCILE_EVERY = 10
+
+# incremental sync snapshots, keyed by (JIRA instance, account credentials, JQL)
+snapshots = LRUCache(max_entries=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_TTL)
+
+
+def parse_jira_date(value):
+    """
+    Parses a JIRA date, e.g. 2015-04-24T10:40:00.000-0500, as it reads on the clock; the offset is dropped
+    :return: naive datetime, or None
+    """
+    if value is None:
+        return None
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def get_window_jql(jql, start=None, end=None):
+    """
+    Narrows a search down to issues created within a window
+    :param jql: JQL string
+    :param start: datetime the window starts at (inclusive), or None for no start
+    :param end: datetime the window ends at (exclusive), or None for no end
+    :return: JQL string
+    """
+    jql_pieces = ['({})'.format(jql)]
+    if start is not None:
+        jql_pieces.append('created >= "{}"'.format(start.strftime('%Y-%m-%d %H:%M')))
+    if end is not None:
+        jql_pieces.append('created < "{}"'.format(end.strftime('%Y-%m-%d %H:%M')))
+    return ' and '.join(jql_pieces)
+
 
 class JIRAIssuesSourceFilters(SourceFilter):
     def get_project_options(account, **kwargs):
-        client = AsyncHTTPClient()
-        req = account.get_request("{}/rest/api/2/project".format(account.jira_url.rstrip('/')))
-        response = yield client.fetch(req)
-        response_object = json.loads(response.body.decode('utf-8'))
-        ret = [{"title": proj['name'], "value": proj['key']} for proj in response_object]
-        return ret
+        projects = yield get_projects(account)
+        return [{"title": title, "value": value} for title, value in projects]
 
     def get_issue_type_options(account, **kwargs):
-        client = AsyncHTTPClient()
-        req = account.get_request("{}/rest/api/2/issuetype".format(account.jira_url.rstrip('/')))
-        response = yield client.fetch(req)
-        response_object = json.loads(response.body.decode('utf-8'))
-        ret = [{"title": ': '.join([type['name'], type['description']]), "value": type['id']} for type in
-               response_object]
-        return ret
+        issue_types = yield get_issue_types(account)
+        return [{"title": title, "value": value} for title, value in issue_types]
 
     def get_states_options(account, projects, **kwargs):
-        options = {}
         if not isinstance(projects, list):
             projects = projects.split(',')
-        for project in projects:
-            client = AsyncHTTPClient()
-            req = account.get_request("{}/rest/api/2/project/{}/statuses".format(account.jira_url.rstrip('/'), project))
-            response = yield client.fetch(req)
-            response_object = json.loads(response.body.decode('utf-8'))
-            for item in response_object:
-                for state in item['statuses']:
-                    options[state['id']] = state['name']
-        return [{'title': value, 'value': key} for key, value in options.items()]
+        statuses = yield get_project_statuses(account, projects)
+        return [{'title': value, 'value': key} for key, value in statuses]
 
     projects = MultiListField(name="Projects", description="JIRA project ID", optional=False,
                               get_options=get_project_options)
@@ -47,12 +86,19 @@ class JIRAIssuesSourceFilters(SourceFilter):
     created = DateField(name="Created", description="Issues created on, before, or during", optional=True)
     resolved = DateField(name="Resolved", description="Issues resolved on, before, or during", optional=True)
 
+    def get_project_jql(self):
+        """
+        Builds a JQL string for every issue in the filter's projects
+        :return: JQL string
+        """
+        return 'project in ({})'.format(','.join(self.projects))
+
     def get_jql(self):
         """
         Builds a JQL string based on the filter's fields
         :return: JQL string
         """
-        jql_pieces = ['project in ({})'.format(','.join(self.projects))]
+        jql_pieces = [self.get_project_jql()]
         if self.issue_types is not None:
             jql_pieces.append('issuetype in ({})'.format(','.join(self.issue_types)))
         if self.states is not None:
@@ -78,6 +124,11 @@ class JIRAIssuesSourceFilters(SourceFilter):
 
 
 class JIRAIssuesSource(StreamingDataSource):
+    # extra search expansions (e.g. renderedFields, changelog) to request; None for JIRA's default
+    search_expand = None
+    # should we only fetch issues updated since our last sync?
+    incremental_sync = True
+
     class Meta:
         identifier = "issues"
         name = "Issues"
@@ -100,6 +151,221 @@ class JIRAIssuesSource(StreamingDataSource):
         priority = TextField(name="Issue Priority", response_loc="fields-priority-name")
         reporter = TextField(name="Reporter Name", response_loc="fields-reporter-name")
 
+    @classmethod
+    def get_search_fields(cls):
+        """
+        Gathers the issue fields our schema reads, so the search only returns those
+        :return: list of JIRA field names
+        """
+        fields = []
+        for name, field in cls.Schema.get_all_fields():
+            if field.response_location is None:
+                # top-level members (id, key) are always returned
+                continue
+            pieces = field.response_location.split('-')
+            if pieces[0] == 'fields' and pieces.__len__() > 1 and pieces[1] not in fields:
+                fields.append(pieces[1])
+        return fields
+
+    @classmethod
+    def get_search_request(cls, account, jql, start_at, max_results, fields=None, **kwargs):
+        """
+        Builds a search request
+        POST <JIRA>/rest/api/2/search
+        :param account: account to make the request for
+        :param jql: JQL string
+        :param start_at: offset of the first issue
+        :param max_results: page size
+        :param fields: issue fields to return, or None for the ones our schema reads
+        :return: HTTPRequest
+        """
+        body = {
+            "jql": jql,
+            "startAt": start_at,
+            "fields": fields if fields is not None else cls.get_search_fields(),
+            "maxResults": max_results
+        }
+        if cls.search_expand is not None and fields is None:
+            body["expand"] = cls.search_expand
+        return account.get_request("{}/rest/api/2/search".format(account.jira_url.rstrip('/')),
+                                   headers={"Content-Type": "application/json"}, method="POST",
+                                   body=json.dumps(body), **kwargs)
+
+    @classmethod
+    @gen.coroutine
+    def search(cls, account, jql, on_issue, skip=0, limit=None, fields=None):
+        """
+        Pages through a search, handing off each issue in order as it streams in
+
+        The first page tells us how many issues there are; we then keep up to FETCH_CONCURRENCY pages in flight.
+        :param account: account to make the requests for
+        :param jql: JQL string
+        :param on_issue: function called with each issue
+        :param skip: number of issues to skip
+        :param limit: maximum number of issues, or None for all of them
+        :param fields: issue fields to return, or None for the ones our schema reads
+        :return: total number of issues matching the search
+        """
+        client = get_http_client()
+        page_limit = limit if limit is not None else 1000
+
+        def fetch_page(start_at, max_results):
+            """
+            Starts the search request for the page at start_at; its issues are parsed as the response streams in
+            """
+            page = StreamedPage('issues', on_issue)
+            req = cls.get_search_request(account, jql, start_at, max_results, fields=fields,
+                                         streaming_callback=page.parser.feed)
+            page.future = client.fetch(req)
+            return page
+
+        # our first page tells us how many issues there are in total
+        page = fetch_page(skip, page_limit)
+        page.make_head()
+        yield page.future
+        resp_obj = page.parser.close()
+
+        # JIRA may hand out smaller pages than we've asked for
+        page_size = resp_obj.get('maxResults', None) or page_limit
+        end = resp_obj['total'] if limit is None else min(resp_obj['total'], skip + limit)
+        offsets = iter(range(resp_obj['startAt'] + page_size, end, page_size))
+
+        # keep up to FETCH_CONCURRENCY pages in flight, consuming them in order; the last page stops at our limit
+        pending = deque(fetch_page(start_at, min(page_size, end - start_at))
+                        for start_at in islice(offsets, FETCH_CONCURRENCY))
+        while pending.__len__() > 0:
+            page = pending.popleft()
+            # issues of the page at the head of the line are handed off as soon as they're parsed
+            page.make_head()
+            yield page.future
+            page.parser.close()
+            start_at = next(offsets, None)
+            if start_at is not None:
+                pending.append(fetch_page(start_at, min(page_size, end - start_at)))
+        return resp_obj['total']
+
+    @classmethod
+    @gen.coroutine
+    def count_issues(cls, account, jql):
+        """
+        Counts the issues matching a search, without fetching any of them
+        :return: number of issues
+        """
+        response = yield get_http_client().fetch(cls.get_search_request(account, jql, 0, 0, fields=['id']))
+        return json.loads(response.body.decode('utf-8'))['total']
+
+    @classmethod
+    @gen.coroutine
+    def get_created_range(cls, account, jql):
+        """
+        Finds the creation dates of the first and last issues matching a search
+        :return: tuple of (earliest, latest) naive datetimes, or None if nothing matches
+        """
+        client = get_http_client()
+        responses = yield [client.fetch(cls.get_search_request(account, '({}) order by created {}'.format(jql, order),
+                                                               0, 1, fields=['created']))
+                           for order in ['asc', 'desc']]
+        bounds = []
+        for response in responses:
+            issues = json.loads(response.body.decode('utf-8'))['issues']
+            if issues.__len__() == 0:
+                return None
+            # we only need these to size our windows, so the offset can go
+            bounds.append(parse_jira_date(issues[0]['fields']['created']))
+        return tuple(bounds)
+
+    @classmethod
+    @gen.coroutine
+    def get_shards(cls, account, jql, total):
+        """
+        Splits a search into windows of creation date, each holding no more than about SHARD_SIZE issues; windows
+        are halved until they're small enough, sized from issue counts
+        :param account: account to make the requests for
+        :param jql: JQL string
+        :param total: number of issues matching the search
+        :return: list of JQL strings, one per window
+        """
+        created_range = yield cls.get_created_range(account, jql)
+        if created_range is None:
+            return [jql]
+        earliest, latest = created_range
+        # our windows are (start, end, count); the first and last are open-ended, so every issue falls in exactly
+        # one window whatever timezone JIRA reads our dates in
+        windows = [(None, None, total)]
+        shards = []
+        while windows.__len__() > 0:
+            splits = []
+            for start, end, count in windows:
+                low, high = start or earliest, end or latest + MIN_SHARD_SPAN
+                if count <= SHARD_SIZE or high - low < MIN_SHARD_SPAN * 2:
+                    if count > 0:
+                        shards.append((start, end))
+                    continue
+                # JQL dates only go down to the minute
+                middle = (low + (high - low) / 2).replace(second=0, microsecond=0)
+                splits.append((start, middle, end, count))
+            # we only need to count the first half of each window, they're all counted at once
+            counts = yield [cls.count_issues(account, get_window_jql(jql, start, middle))
+                            for start, middle, end, count in splits]
+            windows = []
+            for (start, middle, end, count), first_count in zip(splits, counts):
+                windows.append((start, middle, first_count))
+                windows.append((middle, end, max(count - first_count, 0)))
+        shards.sort(key=lambda shard: shard[0] or datetime.min)
+        return [get_window_jql(jql, start, end) for start, end in shards]
+
+    @classmethod
+    @gen.coroutine
+    def refresh_snapshot(cls, account, source_filter, snapshot):
+        """
+        Brings a snapshot up to date with the issues updated since its watermark
+
+        Issues can change so they no longer match our filter (e.g. by changing status), so we also list the IDs of
+        every issue updated in our projects, and drop those that didn't come back from our own search. Deleted
+        issues don't show up as updated at all; every RECONCILE_EVERY refreshes we list the IDs of every issue
+        matching our filter, and drop any we no longer see.
+        :param account: account to make the requests for
+        :param source_filter: JIRAIssuesSourceFilters
+        :param snapshot: dict of watermark, rows keyed by issue ID, and the number of refreshes so far
+        """
+        jql = source_filter.get_jql()
+        since = 'updated >= "{}"'.format((snapshot['watermark'] - WATERMARK_OVERLAP).strftime('%Y-%m-%d %H:%M'))
+        app_log.info("Incremental retrieval of issues for {} with {}".format(account._id, since))
+        rows = snapshot['rows']
+        watermark = snapshot['watermark']
+        matched = set()
+        snapshot['refreshes'] += 1
+
+        def handle_issue(issue):
+            nonlocal watermark
+            matched.add(issue['id'])
+            # changed issues are merged into our snapshot; new ones go on the end
+            rows[issue['id']] = cls.format_data_to_schema(issue)
+            updated = parse_jira_date(issue['fields'].get('updated', None))
+            if updated is not None and updated > watermark:
+                watermark = updated
+
+        searches = [cls.search(account, '({}) and {}'.format(jql, since), handle_issue)]
+        changed, current = None, None
+        project_jql = source_filter.get_project_jql()
+        if project_jql != jql:
+            changed = set()
+            searches.append(cls.search(account, '({}) and {}'.format(project_jql, since),
+                                       lambda issue: changed.add(issue['id']), fields=['id']))
+        if RECONCILE_EVERY is not None and snapshot['refreshes'] % RECONCILE_EVERY == 0:
+            app_log.info("Reconciling issues for {}".format(account._id))
+            current = set()
+            searches.append(cls.search(account, jql, lambda issue: current.add(issue['id']), fields=['id']))
+        yield searches
+
+        if changed is not None:
+            for issue_id in changed - matched:
+                rows.pop(issue_id, None)
+        if current is not None:
+            for issue_id in set(rows.keys()) - current - matched:
+                rows.pop(issue_id)
+        snapshot['watermark'] = watermark
+
     @classmethod
     @gen.coroutine
     def get_data(cls, account, source_filter, limit=100, skip=0):
@@ -108,58 +374,89 @@ class JIRAIssuesSource(StreamingDataSource):
         POST <JIRA>/rest/api/2/search
             -- data: JQL:
                 {"jql":"project = <proj>","startAt":<skip>,"maxResults":<limit>,"fields":[<fields you want>]}
-        """
-        client = AsyncHTTPClient()
 
+        Full exports of more than SHARD_THRESHOLD issues are split into windows of creation date, which are
+        searched concurrently rather than paged through with ever deeper offsets.  Full exports also keep a snapshot
+        of the issues; until it expires, refreshes only fetch issues updated since.
+        """
         source_filter = JIRAIssuesSourceFilters(source_filter)
 
         if source_filter.projects is None:
             raise ValueError('required parameter projects missing')
 
         app_log.info("Start retrieval of issues for account {}".format(account._id))
-        uri = "{}/rest/api/2/search".format(account.jira_url.rstrip('/'))
-        jql = {
-            "jql": source_filter.get_jql(),
-            "startAt": skip
-        }
-        page_limit = limit if limit is not None else 1000
-        jql.update({"maxResults": page_limit})
+        jql = source_filter.get_jql()
+
+        # incremental syncs are only done for full exports
+        incremental = cls.incremental_sync and limit is None and skip == 0
+        snapshot_key = (account.jira_url.rstrip('/'), account.credential_key, jql)
+        snapshot = snapshots.get(snapshot_key) if incremental else None
+
+        writer = RowWriter(cls.write)
+        if snapshot is not None:
+            yield cls.refresh_snapshot(account, source_filter, snapshot)
+            writer.open()
+            for formatted in snapshot['rows'].values():
+                writer.write_row(formatted)
+            app_log.info("Finished retrieval of {} issues for {}".format(writer.count, account._id))
+            writer.close()
+            return
+
+        # our snapshot's rows keyed by issue ID, and the latest update we've seen
+        rows = OrderedDict()
+        watermark = None
+
+        def take_issue(issue):
+            nonlocal watermark
+            formatted = cls.format_data_to_schema(issue)
+            if incremental:
+                rows[issue['id']] = formatted
+                updated = parse_jira_date(issue['fields'].get('updated', None))
+                if updated is not None and (watermark is None or updated > watermark):
+                    watermark = updated
+            writer.write_row(formatted)
+
+        shards = None
+        if SHARD_THRESHOLD is not None and limit is None and skip == 0:
+            total = yield cls.count_issues(account, jql)
+            if total > SHARD_THRESHOLD:
+                shards = deque((yield cls.get_shards(account, jql, total)))
+                app_log.info("Retrieving {} issues for {} in {} windows".format(total, account._id,
+                                                                               shards.__len__()))
 
         # start our list
-        cls.write('[')
-        count = 0
-
-        while True:
-            app_log.info("Next page for {}, retrieved {} thus far".format(account._id, count))
-            req = account.get_request(uri, headers={"Content-Type": "application/json"},
-                                      method="POST", body=json.dumps(jql))
-
-            response = yield client.fetch(req)
-
-            page_data = response.body.decode('utf-8')
-            resp_obj = json.loads(page_data)
-
-            for issue in resp_obj['issues']:
-                if count > 0:
-                    # if we aren't the first in the list, be sure we put our delimiter in
-                    cls.write(',')
-
-                this_issue = cls.format_data_to_schema(issue)
-                cls.write(json.dumps(this_issue))
-                count += 1
-
-            # handle pagination
-            if limit is not None and count >= limit:
-                # we've taken more than our limit, no need to continue
-                break
-            if resp_obj['total'] > resp_obj['startAt'] + page_limit:
-                # there is a next page
-                new_start = resp_obj['startAt'] + page_limit
-                jql.update({'startAt': new_start})
-            else:
-                # no new page, let's break
-                break
-
-        app_log.info("Finished retrieval of {} issues for {}".format(count, account._id))
+        writer.open()
+
+        if shards is None:
+            yield cls.search(account, jql, take_issue, skip, limit)
+        else:
+            # windows can overlap if issues change while we're at it, so we only take each issue once
+            seen = set()
+            cancelled = False
+
+            def handle_issue(issue):
+                if cancelled or issue['id'] in seen:
+                    return
+                seen.add(issue['id'])
+                take_issue(issue)
+
+            @gen.coroutine
+            def run_shards():
+                nonlocal cancelled
+                try:
+                    while shards.__len__() > 0 and not cancelled:
+                        yield cls.search(account, shards.popleft(), handle_issue)
+                        app_log.info("Window retrieved for {}, {} issues thus far".format(account._id, writer.count))
+                except Exception:
+                    # don't let our other windows carry on writing
+                    cancelled = True
+                    raise
+
+            yield [run_shards() for n in range(SHARD_CONCURRENCY)]
+
+        if incremental and watermark is not None:
+            snapshots.set(snapshot_key, {'watermark': watermark, 'rows': rows, 'refreshes': 0})
+
+        app_log.info("Finished retrieval of {} issues for {}".format(writer.count, account._id))
         # be sure to close our array
-        cls.write(']')
+        writer.close()
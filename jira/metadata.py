@@ -0,0 +1,195 @@
+from collections import OrderedDict
+import json
+import time
+from urllib.parse import urlencode
+
+from tornado import gen
+from tornado.log import app_log
+
+from common.cache import LRUCache
+from common.http import get_http_client
+
+# how long are statuses good for (in seconds)?
+STATUS_TTL = 900
+# how many status lists do we hold on to?
+STATUS_CACHE_SIZE = 2000
+# past how many projects do we look up every status on the instance in one request instead? (None to never)
+# every status includes those of other projects' workflows, so this is off unless a deployment opts in
+GLOBAL_STATUS_THRESHOLD = None
+
+# how long is account metadata (projects, issue types) fresh for (in seconds)?
+METADATA_TTL = 600
+# how long past that can we still answer with it, while it's refreshed in the background (in seconds)?
+METADATA_STALE_TTL = 86400
+# how many accounts' metadata do we hold on to?
+METADATA_CACHE_SIZE = 1000
+# only list this many of the user's most recently viewed projects (None for every project)
+PROJECT_LIST_RECENT = None
+
+# account metadata as (fetched, list of (title, value) tuples), keyed by (JIRA instance, account credentials, name)
+metadata_cache = LRUCache(max_entries=METADATA_CACHE_SIZE, ttl=METADATA_TTL + METADATA_STALE_TTL)
+# metadata requests in flight, by the same key
+metadata_requests = {}
+# statuses as (id, name) tuples, keyed by (JIRA instance, account credentials, project); a project of None holds
+# every status
+status_cache = LRUCache(max_entries=STATUS_CACHE_SIZE, ttl=STATUS_TTL)
+# status lookups in flight, by the same key
+status_requests = {}
+
+
+def get_base_url(account):
+    return account.jira_url.rstrip('/')
+
+
+@gen.coroutine
+def fetch_statuses(account, project=None):
+    """
+    Fetches statuses from JIRA
+    GET /rest/api/2/project/:project/statuses
+    or GET /rest/api/2/status
+    :param account: account to make the request for
+    :param project: project key, or None for every status on the instance
+    :return: list of (id, name) tuples
+    """
+    if project is None:
+        req = account.get_request("{}/rest/api/2/status".format(get_base_url(account)))
+    else:
+        req = account.get_request("{}/rest/api/2/project/{}/statuses".format(get_base_url(account), project))
+    response = yield get_http_client().fetch(req)
+    response_object = json.loads(response.body.decode('utf-8'))
+    if project is None:
+        return [(state['id'], state['name']) for state in response_object]
+    # a project's statuses are listed per issue type
+    return [(state['id'], state['name']) for item in response_object for state in item['statuses']]
+
+
+@gen.coroutine
+def get_statuses(account, project=None):
+    """
+    Gets statuses for a project, from our cache where we can; concurrent lookups of the same project share a request
+    :param account: account to get statuses for
+    :param project: project key, or None for every status on the instance
+    :return: list of (id, name) tuples
+    """
+    key = (get_base_url(account), account.credential_key, project)
+    statuses = status_cache.get(key)
+    if statuses is None:
+        request = status_requests.get(key, None)
+        if request is None:
+            request = fetch_statuses(account, project)
+            status_requests[key] = request
+        try:
+            statuses = yield request
+        finally:
+            status_requests.pop(key, None)
+        status_cache.set(key, statuses)
+    return statuses
+
+
+@gen.coroutine
+def get_project_statuses(account, projects):
+    """
+    Gets the statuses used by a set of projects, looking the projects up all at once
+    :param account: account to get statuses for
+    :param projects: list of project keys
+    :return: list of (id, name) tuples, without duplicates
+    """
+    # each project is only looked up once
+    projects = list(OrderedDict.fromkeys(projects))
+    if GLOBAL_STATUS_THRESHOLD is not None and projects.__len__() > GLOBAL_STATUS_THRESHOLD:
+        # with this many projects, every status on the instance is cheaper to get
+        lookups = [get_statuses(account)]
+    else:
+        lookups = [get_statuses(account, project) for project in projects]
+    results = yield lookups
+    statuses = OrderedDict()
+    for result in results:
+        for state_id, state_name in result:
+            statuses[state_id] = state_name
+    return list(statuses.items())
+
+
+@gen.coroutine
+def fetch_projects(account):
+    """
+    Fetches the projects an account can see
+    GET /rest/api/2/project
+    :return: list of (name, key) tuples
+    """
+    uri = "{}/rest/api/2/project".format(get_base_url(account))
+    if PROJECT_LIST_RECENT is not None:
+        uri += '?' + urlencode({'recent': PROJECT_LIST_RECENT})
+    response = yield get_http_client().fetch(account.get_request(uri))
+    response_object = json.loads(response.body.decode('utf-8'))
+    return [(proj['name'], proj['key']) for proj in response_object]
+
+
+@gen.coroutine
+def fetch_issue_types(account):
+    """
+    Fetches the issue types an account can see
+    GET /rest/api/2/issuetype
+    :return: list of (name: description, id) tuples
+    """
+    response = yield get_http_client().fetch(
+        account.get_request("{}/rest/api/2/issuetype".format(get_base_url(account))))
+    response_object = json.loads(response.body.decode('utf-8'))
+    return [(': '.join([type['name'], type['description']]), type['id']) for type in response_object]
+
+
+def refresh_metadata(account, name, fetcher):
+    """
+    Fetches a piece of account metadata into our cache, unless that's already underway
+    :return: Future resolving to the metadata
+    """
+    key = (get_base_url(account), account.credential_key, name)
+    request = metadata_requests.get(key, None)
+    if request is None:
+        request = fetcher(account)
+        metadata_requests[key] = request
+
+        def finished(future):
+            metadata_requests.pop(key, None)
+            if future.exception() is None:
+                metadata_cache.set(key, (time.time(), future.result()))
+            else:
+                app_log.warning("Failed to refresh JIRA {} for {}: {}".format(name, account._id, future.exception()))
+
+        request.add_done_callback(finished)
+    return request
+
+
+@gen.coroutine
+def get_metadata(account, name, fetcher):
+    """
+    Gets a piece of account metadata; fresh metadata comes straight from our cache, and stale metadata is answered
+    with while it's refreshed in the background
+    :param account: account to get metadata for
+    :param name: name the metadata is cached under, e.g. projects
+    :param fetcher: coroutine fetching the metadata for an account
+    :return: list of (title, value) tuples
+    """
+    cached = metadata_cache.get((get_base_url(account), account.credential_key, name))
+    if cached is not None:
+        fetched, values = cached
+        if time.time() - fetched > METADATA_TTL:
+            refresh_metadata(account, name, fetcher)
+        return values
+    values = yield refresh_metadata(account, name, fetcher)
+    return values
+
+
+def get_projects(account):
+    """
+    Gets the projects an account can see
+    :return: Future resolving to a list of (name, key) tuples
+    """
+    return get_metadata(account, 'projects', fetch_projects)
+
+
+def get_issue_types(account):
+    """
+    Gets the issue types an account can see
+    :return: Future resolving to a list of (name: description, id) tuples
+    """
+    return get_metadata(account, 'issuetypes', fetch_issue_types)
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from unittest import mock
+import random
+import re
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from jira.issues import JIRAIssuesSource, get_window_jql, MIN_SHARD_SPAN
+
+JQL = 'project in (13)'
+window_regex = re.compile(r'created ([<>]=?) "([^"]+)"')
+
+
+def parse_window(jql):
+    start = end = None
+    for op, value in window_regex.findall(jql):
+        value = datetime.strptime(value, '%Y-%m-%d %H:%M')
+        if op == '>=':
+            start = value
+        else:
+            end = value
+    return start, end
+
+
+class JIRAShardTests(unittest.TestCase):
+    def get_shards(self, created, shard_size):
+        """
+        Splits a search over issues created at the given times, counting them as JIRA would
+        """
+        counted = []
+
+        def count_window(jql):
+            start, end = parse_window(jql)
+            return sum(1 for date in created
+                       if (start is None or date >= start) and (end is None or date < end))
+
+        @gen.coroutine
+        def count_issues(account, jql):
+            counted.append(jql)
+            return count_window(jql)
+
+        @gen.coroutine
+        def get_created_range(account, jql):
+            if created.__len__() == 0:
+                return None
+            return min(created), max(created)
+
+        with mock.patch.object(JIRAIssuesSource, 'count_issues', count_issues), \
+                mock.patch.object(JIRAIssuesSource, 'get_created_range', get_created_range), \
+                mock.patch('jira.issues.SHARD_SIZE', shard_size):
+            shards = IOLoop.current().run_sync(lambda: JIRAIssuesSource.get_shards(None, JQL, created.__len__()))
+        return shards, [count_window(shard) for shard in shards], counted
+
+    def assertPartitioned(self, shards, counts, total):
+        # every issue falls in exactly one window, and the windows are in order; windows holding nothing are
+        # dropped, so they needn't meet
+        self.assertEqual(sum(counts), total)
+        windows = [parse_window(shard) for shard in shards]
+        self.assertIsNone(windows[0][0])
+        self.assertIsNone(windows[-1][1])
+        for (start, end), (next_start, next_end) in zip(windows, windows[1:]):
+            self.assertLessEqual(end, next_start)
+        for shard in shards:
+            self.assertTrue(shard.startswith('({})'.format(JQL)))
+
+    def test_spread_out(self):
+        rng = random.Random(13)
+        earliest = datetime(2012, 1, 1)
+        created = [earliest + timedelta(seconds=rng.randint(0, 3 * 365 * 86400)) for n in range(5000)]
+        shards, counts, counted = self.get_shards(created, 500)
+        self.assertPartitioned(shards, counts, created.__len__())
+        self.assertGreaterEqual(shards.__len__(), 10)
+        for count in counts:
+            self.assertLessEqual(count, 500)
+            self.assertGreater(count, 0)
+
+    def test_skewed(self):
+        # most issues were created in a burst (e.g. an import), the rest trickle in over years
+        rng = random.Random(42)
+        earliest = datetime(2010, 6, 1)
+        created = [earliest + timedelta(days=rng.randint(0, 2000), seconds=rng.randint(0, 86400))
+                   for n in range(300)]
+        created += [datetime(2014, 3, 2, 9, 30) + timedelta(seconds=rng.randint(0, 6 * 3600)) for n in range(3000)]
+        shards, counts, counted = self.get_shards(created, 250)
+        self.assertPartitioned(shards, counts, created.__len__())
+        for count in counts:
+            self.assertLessEqual(count, 250)
+
+    def test_cannot_split_below_a_minute(self):
+        # JQL dates only go down to the minute, so a window that narrow is kept however many issues it holds
+        created = [datetime(2015, 4, 24, 10, 40, second) for second in range(60)] * 20
+        created.append(datetime(2015, 4, 20))
+        shards, counts, counted = self.get_shards(created, 100)
+        self.assertPartitioned(shards, counts, created.__len__())
+        self.assertIn(1200, counts)
+        for shard in shards:
+            start, end = parse_window(shard)
+            if start is not None and end is not None:
+                self.assertGreaterEqual(end - start, MIN_SHARD_SPAN)
+
+    def test_small_enough(self):
+        created = [datetime(2015, 4, 24) + timedelta(hours=n) for n in range(100)]
+        shards, counts, counted = self.get_shards(created, 500)
+        self.assertEqual(shards, [get_window_jql(JQL)])
+        self.assertEqual(counted, [])
+
+    def test_nothing_matches(self):
+        shards, counts, counted = self.get_shards([], 500)
+        self.assertEqual(shards, [JQL])
+        self.assertEqual(counted, [])
@@ -4,7 +4,8 @@ from urllib.request import urlopen, Request, HTTPError
 from datetime import timedelta, datetime
 
 from oauthlib.oauth2.rfc6749.clients.base import AUTH_HEADER
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 from tornado.httpclient import HTTPError as AsyncHTTPError
 from tornado import gen, log
 
@@ -52,7 +53,7 @@ class MicrosoftLiveAccount(AppOAuthv2Account):
     def validate(self):
         try:
             yield self.do_token_refresh()
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://apis.live.net/v5.0/me")
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
@@ -65,7 +66,7 @@ class MicrosoftLiveAccount(AppOAuthv2Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://apis.live.net/v5.0/me")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
@@ -2,7 +2,8 @@ import json
 from datetime import timedelta
 
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
+from common.http import get_http_client
 from tornado.log import app_log
 from tornado.locks import BoundedSemaphore, Condition
 from tornado.queues import Queue
@@ -36,7 +37,7 @@ class OneDriveFileFilter(SourceFilter):
                 app_log.info("Fetching page {}".format(page_no))
                 working.add(current_url)
                 req = account.get_request(current_url)
-                client = AsyncHTTPClient()
+                client = get_http_client()
                 response = yield client.fetch(req)
                 done.add(current_url)
                 app_log.info("Page {} downloaded".format(page_no))
@@ -101,7 +102,7 @@ class OneDriveFileSource(StreamingDataSource):
 
         app_log.info("Starting to retrieve file for {}".format(account._id))
 
-        client = AsyncHTTPClient()
+        client = get_http_client()
         uri = "https://api.onedrive.com/v1.0/drive/items/{}/content".format(source_filter.file)
         lock = Condition()
 
@@ -5,6 +5,9 @@ from .filter import TargetprocessAssignablesFilter
 
 
 class TargetprocessAssignablesSource(TargetprocessAssignable):
+    # refreshes only pull entities modified since the last sync
+    incremental_sync = True
+
     class Meta:
         identifier = "assignables"
         name = "All Entities"
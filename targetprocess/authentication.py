@@ -1,7 +1,10 @@
 from urllib import parse
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPRequest, HTTPError
+from common.http import get_http_client
 from tornado import gen
 
+from common.cache import get_credential_key
+from targetprocess.filter import invalidate_options
 from vizydrop.sdk.account import Account, AppHTTPBasicAuthAccount
 from vizydrop import fields
 
@@ -35,18 +38,27 @@ class TargetprocessBasicAuth(AppHTTPBasicAuthAccount):
         parsed = parse.urlparse(self.tp_url)
         return parsed.hostname or self.tp_url
 
+    @property
+    def credential_key(self):
+        """
+        Key for caching what this account can see
+        """
+        return get_credential_key(self.username, self.password)
+
     @gen.coroutine
     def validate(self):
         if not self.tp_url:
             raise ValueError("required field tp_url missing")
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
 
             uri = "{}/api/v1/Authentication".format(self.tp_url)
             req = self.get_request(uri)
 
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
+                # the account may have been (re)connected to see something else, so drop what we've cached for it
+                invalidate_options(self)
                 return True, None
             else:
                 return False, resp.body.decode('utf-8')
@@ -58,7 +70,7 @@ class TargetprocessBasicAuth(AppHTTPBasicAuthAccount):
         if not self.tp_url:
             raise ValueError("required field tp_url missing")
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             uri = "{}/api/v1/Users?where=Login eq '{}'&take=[FirstName,LastName]".format(self.tp_url, self.username)
             req = self.get_request(uri)
             resp = yield client.fetch(req)
@@ -93,18 +105,27 @@ class TargetproessTokenAuth(Account):
         parsed = parse.urlparse(self.tp_url)
         return parsed.hostname or self.tp_url
 
+    @property
+    def credential_key(self):
+        """
+        Key for caching what this account can see
+        """
+        return get_credential_key(self.token)
+
     @gen.coroutine
     def validate(self):
         if not self.tp_url:
             raise ValueError("required field tp_url missing")
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
 
             uri = "{}/api/v1/Authentication".format(self.tp_url)
             req = self.get_request(uri)
 
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
+                # the account may have been (re)connected to see something else, so drop what we've cached for it
+                invalidate_options(self)
                 return True, None
             else:
                 return False, resp.body.decode('utf-8')
@@ -116,7 +137,7 @@ class TargetproessTokenAuth(Account):
         if not self.tp_url:
             raise ValueError("required field tp_url missing")
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
 
             uri = "{}/api/v1/Context?format=json".format(self.tp_url)
             req = self.get_request(uri)
@@ -1,15 +1,66 @@
-import json
+from tornado import gen
 
-from tornado.httpclient import AsyncHTTPClient
+from common.cache import LRUCache
+from targetprocess.pager import fetch_pages
 from vizydrop.sdk.source import SourceFilter
 from vizydrop.fields import *
 
+# how long are option lists good for (in seconds)?
+OPTIONS_TTL = 600
+# how many option lists do we hold on to?
+OPTIONS_CACHE_SIZE = 500
+
+# filter options, keyed by (TP instance, account credentials, collection)
+option_cache = LRUCache(max_entries=OPTIONS_CACHE_SIZE, ttl=OPTIONS_TTL)
+
+
+def invalidate_options(account):
+    """
+    Drops any filter options we have cached for an account
+    """
+    for collection in ['Projects', 'Teams']:
+        option_cache.pop((account.tp_url, account.credential_key, collection))
+
+
+@gen.coroutine
+def get_collection_options(account, collection, request=None, **kwargs):
+    """
+    Gathers everything in a TP collection as filter options, cached per account
+    :param account: account to gather options for
+    :param collection: TP API collection, e.g. Projects
+    :param request: the options request; ?refresh=1 skips our cache
+    :return: list of options
+    """
+    key = (account.tp_url, account.credential_key, collection)
+    if request is not None and request.query_arguments.get('refresh', None):
+        option_cache.pop(key)
+    options = option_cache.get(key)
+    if options is not None:
+        return options
+
+    options = []
+
+    def add_option(item):
+        options.append({"value": item['Id'], "title": item['Name']})
+
+    yield fetch_pages(account, "{}/api/v1/{}".format(account.tp_url, collection), {'include': '[Id,Name]'},
+                      add_option)
+    option_cache.set(key, options)
+    return options
+
 
 class TargetprocessBaseFilter(SourceFilter):
     opened = DateField(name="Opened", description="Date which an entity was opened", optional=True)
     started = DateField(name="Started", description="Date which work began on an entity", optional=True)
     closed = DateField(name="Closed", description="Date which an entity was closed", optional=True)
 
+    def get_project_where_clause(self):
+        """
+        Builds a where clause for every entity in the filter's projects
+        :return: where clause, or an empty string if we aren't limited to any projects
+        """
+        return ""
+
     def get_where_clause(self, return_formatted=True):
         where_pieces = []
         if self.opened:
@@ -53,40 +104,12 @@ class TargetprocessBaseFilter(SourceFilter):
 
 class TargetprocessAssignablesFilter(TargetprocessBaseFilter):
     def get_project_options(account, **kwargs):
-        client = AsyncHTTPClient()
-        uri = "{}/api/v1/Projects?take=100".format(account.tp_url)
-        ret = []
-        while uri is not None:
-            req = account.get_request(uri)
-            response = yield client.fetch(req)
-            options = json.loads(response.body.decode('utf-8'))
-            for option in options['Items']:
-                ret.append({"value": option['Id'], "title": option['Name']})
-
-            uri = options.get('Next', None)
-            if uri is not None:
-                # This escapes the filter, otherwise every request past the first will
-                # return a 400
-                uri = uri.replace(' ', '+')
-        return ret
+        options = yield get_collection_options(account, 'Projects', **kwargs)
+        return options
 
     def get_team_options(account, **kwargs):
-        client = AsyncHTTPClient()
-        uri = "{}/api/v1/Teams?take=100".format(account.tp_url)
-        ret = []
-        while uri is not None:
-            req = account.get_request(uri)
-            response = yield client.fetch(req)
-            options = json.loads(response.body.decode('utf-8'))
-            for option in options['Items']:
-                ret.append({"value": option['Id'], "title": option['Name']})
-
-            uri = options.get('Next', None)
-            if uri is not None:
-                # This escapes the filter, otherwise every request past the first will
-                # return a 400
-                uri = uri.replace(' ', '+')
-        return ret
+        options = yield get_collection_options(account, 'Teams', **kwargs)
+        return options
 
     projects = MultiListField(name="Project", description="Project IDs", optional=False,
                               get_options=get_project_options)
@@ -94,13 +117,17 @@ class TargetprocessAssignablesFilter(TargetprocessBaseFilter):
     is_final = BooleanField(name="Is Final", description="Only include finished (closed) entities", optional=True)
     is_initial = BooleanField(name="Is Initial", description="Only include initial (backlog) entities", optional=True)
 
+    def get_project_where_clause(self):
+        if not self.projects:
+            return ""
+        if self.projects.__len__() > 1:
+            return "Project.Id in ({})".format(','.join(self.projects))
+        return "Project.Id eq {}".format(self.projects[0])
+
     def get_where_clause(self, return_formatted=True):
         where_pieces = super().get_where_clause(return_formatted=False)
         if self.projects:
-            if self.projects.__len__() > 1:
-                where_pieces.append("Project.Id in ({})".format(','.join(self.projects)))
-            else:
-                where_pieces.append("Project.Id eq {}".format(self.projects[0]))
+            where_pieces.append(self.get_project_where_clause())
         if self.teams:
             if self.teams.__len__() > 1:
                 where_pieces.append("Team.Id in ({})".format(','.join(self.teams)))
@@ -0,0 +1,77 @@
+from urllib.parse import urlencode
+
+from tornado import gen
+from tornado.log import app_log
+
+from common.http import get_http_client
+from common.jsonstream import StreamedPage
+
+# how many page requests can we have in flight at once?
+FETCH_CONCURRENCY = 5
+# the TP API's maximum page size
+MAX_TAKE = 1000
+
+
+@gen.coroutine
+def fetch_pages(account, uri, params, on_item, skip=0, take=MAX_TAKE):
+    """
+    Pages through a TP API collection, handing off its items in order as they stream in
+
+    The first page is fetched on its own; once we know there is more to come, we keep up to FETCH_CONCURRENCY
+    skip/take windows in flight and consume them in page order.
+    :param account: account to make the requests for
+    :param uri: collection URI, e.g. https://example.tpondemand.com/api/v1/Projects
+    :param params: dict of query parameters for every page (where, include...)
+    :param on_item: function called with each item, in order
+    :param skip: number of items to skip
+    :param take: page size
+    :return: number of items handed off
+    """
+    client = get_http_client()
+    item_count = 0
+
+    def handle_item(item):
+        nonlocal item_count
+        item_count += 1
+        on_item(item)
+
+    def fetch_page(page_no):
+        """
+        Starts the request for a skip/take window; its items are parsed as the response streams in
+        """
+        page_params = dict(params, take=take)
+        page_skip = skip + page_no * take
+        if page_skip > 0:
+            page_params['skip'] = page_skip
+        page = StreamedPage('Items', handle_item)
+        req = account.get_request('?'.join([uri, urlencode(page_params)]), streaming_callback=page.parser.feed)
+        page.future = client.fetch(req)
+        return page
+
+    pending = {0: fetch_page(0)}
+    next_page = 1
+    page_no = 0
+
+    app_log.info("Start retrieval of {}; first page...".format(uri))
+    while True:
+        page = pending.pop(page_no)
+        # items of the page at the head of the line are handed off as soon as they're parsed
+        page.make_head()
+        yield page.future
+        resp_obj = page.parser.close()
+
+        if resp_obj.get('Next', None) is None:
+            app_log.info("At end of response for {}".format(uri))
+            break
+
+        app_log.info("Next page for {}, retrieved {} thus far".format(uri, item_count))
+        page_no += 1
+        # top up our window of in-flight requests
+        while next_page < page_no + FETCH_CONCURRENCY:
+            pending[next_page] = fetch_page(next_page)
+            next_page += 1
+
+    # any windows still in flight are past the end of our data, we don't care how they turn out
+    for page in pending.values():
+        page.future.add_done_callback(lambda f: f.exception())
+    return item_count
@@ -1,21 +1,34 @@
-from datetime import datetime
-import json
-import sys
+from collections import OrderedDict
 from tornado import gen
-from urllib.parse import urlencode
-
-from dateutil.parser import parse as parse_date
-import re
-from tornado.httpclient import AsyncHTTPClient
 
 from tornado.log import app_log
 
+from common.cache import LRUCache
+from common.writer import RowWriter
 from targetprocess.filter import TargetprocessAssignablesFilter
+from targetprocess.pager import fetch_pages, MAX_TAKE
+from targetprocess.transformer import TargetprocessRowTransformer, get_location_value, get_tp_date_millis, \
+    format_tp_date_for_query
 from vizydrop.fields import NumberField, TextField, DateField, DecimalField, IDField
 from vizydrop.sdk.source import StreamingDataSource, SourceSchema
 
+# how long an incremental snapshot is used before we do a full refresh (in seconds)
+SNAPSHOT_TTL = 3600
+# how many incremental snapshots do we hold on to?
+SNAPSHOT_CACHE_SIZE = 50
+# every how many incremental refreshes do we check for deleted entities? (None to never)
+RECONCILE_EVERY = 10
+
+# incremental sync snapshots, keyed by (TP instance, account credentials, source, where clause)
+snapshots = LRUCache(max_entries=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_TTL)
+
 
 class TargetprocessGeneral(StreamingDataSource):
+    # row transformers, built once per schema
+    _transformers = {}
+    # should we only fetch entities modified since our last sync?
+    incremental_sync = False
+
     class Meta:
         tp_api_call = "Generals"
 
@@ -30,23 +43,39 @@ class TargetprocessGeneral(StreamingDataSource):
         Tags = TextField(name="Tags", description="List of tags")
 
     @classmethod
-    def get_api_includes(cls):
+    def get_api_includes(cls, extra=None):
         """
         Gathers the TP API's include fields based on our source schema
+        :param extra: additional fields to include that aren't in our schema
         :return:
         """
-        includes = []
-        for name, field in cls.Schema.get_all_fields():
-            if field.response_location is not None:
-                # convert our response location pieces delimited by a hyphen
-                # to TP's API x[y[z]] format for include
-                pieces = field.response_location.split('-')
-                include = '['.join(pieces) + ''.join([']' for n in range(pieces.__len__() - 1)])
-                includes.append(include)
-            else:
-                # if we have no response location, our name is the location
-                includes.append(name)
-        return '[{}]'.format(','.join(includes))
+        transformer = cls.get_row_transformer()
+        if not extra:
+            return transformer.includes
+        return '[{}]'.format(','.join(transformer.include_fields + tuple(extra)))
+
+    @classmethod
+    def get_row_transformer(cls):
+        """
+        Gets the row transformer for our source schema, building it on first use
+        :return: TargetprocessRowTransformer
+        """
+        transformer = cls._transformers.get(cls.Schema, None)
+        if transformer is None:
+            transformer = TargetprocessRowTransformer(cls.Schema)
+            cls._transformers[cls.Schema] = transformer
+        return transformer
+
+    @classmethod
+    def format_data_to_schema(cls, data):
+        """
+        Formats TP API data to our schema, converting TP dates to ISO-8601
+        :param data: item or list of items to format
+        :return: formatted data
+        """
+        if type(data) is list:
+            return [cls.format_data_to_schema(item) for item in data]
+        return cls.get_row_transformer().transform(data)
 
     @classmethod
     def _get_value_from_location(cls, item, location):
@@ -56,12 +85,72 @@ class TargetprocessGeneral(StreamingDataSource):
         :param location: location to get the value from, nested dictionaries can be separated by a hyphen (-)
         :return: value
         """
-        if location is None or item is None:
+        if location is None:
             return None
-        if 'Items' in item.keys():
-            # handle our inner collections
-            return ','.join([cls._get_value_from_location(i, location) for i in item['Items']])
-        return super(TargetprocessGeneral, cls)._get_value_from_location(item, location)
+        return get_location_value(item, tuple(location.split('-')))
+
+    @classmethod
+    @gen.coroutine
+    def refresh_snapshot(cls, account, source_filter, snapshot):
+        """
+        Brings a snapshot up to date with the entities modified since its watermark
+
+        Entities can change so they no longer match our filter (e.g. by moving to a final state or another team),
+        so we also list the IDs of every entity modified in our projects, and drop those that didn't come back from
+        our own query. Deleted entities don't show up as modified at all; every RECONCILE_EVERY refreshes we list
+        the IDs of every entity matching our filter, and drop any we no longer see.
+        :param account: account to make the requests for
+        :param source_filter: TargetprocessBaseFilter
+        :param snapshot: dict of watermark, rows keyed by entity ID, and the number of refreshes so far
+        """
+        uri = "{}/api/v1/{}".format(account.tp_url, cls.Meta.tp_api_call)
+        where_clause = source_filter.get_where_clause()
+        since = "(ModifyDate gte '{}')".format(snapshot['watermark'])
+        app_log.info("Incremental retrieval of {} changed since {}".format(cls.Meta.tp_api_call,
+                                                                           snapshot['watermark']))
+        rows = snapshot['rows']
+        matched = set()
+        latest_modified, latest_millis = None, None
+        snapshot['refreshes'] += 1
+
+        def handle_item(item):
+            nonlocal latest_modified, latest_millis
+            matched.add(item['Id'])
+            # changed entities are merged into our snapshot; new ones go on the end
+            rows[item['Id']] = cls.format_data_to_schema(item)
+            modified_millis = get_tp_date_millis(item.get('ModifyDate', None))
+            if modified_millis is not None and (latest_millis is None or modified_millis > latest_millis):
+                latest_modified, latest_millis = item['ModifyDate'], modified_millis
+
+        def get_where(*clauses):
+            return ' and '.join(clause for clause in clauses if clause != "")
+
+        fetches = [fetch_pages(account, uri, {'where': get_where(where_clause, since),
+                                              'include': cls.get_api_includes(extra=['ModifyDate'])}, handle_item)]
+        changed, current = None, None
+        project_clause = source_filter.get_project_where_clause()
+        project_clause = '({})'.format(project_clause) if project_clause != "" else ""
+        if project_clause != where_clause:
+            changed = set()
+            fetches.append(fetch_pages(account, uri, {'where': get_where(project_clause, since), 'include': '[Id]'},
+                                       lambda item: changed.add(item['Id'])))
+        if RECONCILE_EVERY is not None and snapshot['refreshes'] % RECONCILE_EVERY == 0:
+            app_log.info("Reconciling {} for {}".format(cls.Meta.tp_api_call, account._id))
+            current = set()
+            params = {'include': '[Id]'}
+            if where_clause != "":
+                params['where'] = where_clause
+            fetches.append(fetch_pages(account, uri, params, lambda item: current.add(item['Id'])))
+        yield fetches
+
+        if changed is not None:
+            for entity_id in changed - matched:
+                rows.pop(entity_id, None)
+        if current is not None:
+            for entity_id in set(rows.keys()) - current - matched:
+                rows.pop(entity_id)
+        if latest_modified is not None:
+            snapshot['watermark'] = format_tp_date_for_query(latest_modified)
 
     @classmethod
     @gen.coroutine
@@ -75,77 +164,62 @@ class TargetprocessGeneral(StreamingDataSource):
 
         where_clause = source_filter.get_where_clause()
 
-        client = AsyncHTTPClient()
-
         app_log.info("Start retrieval of {} for {}".format(cls.Meta.tp_api_call, account._id))
 
+        # incremental syncs are only done for full exports
+        incremental = cls.incremental_sync and limit is None and skip == 0
+        snapshot_key = (account.tp_url, account.credential_key, cls.Meta.identifier,
+                        where_clause) if incremental else None
+        snapshot = snapshots.get(snapshot_key) if incremental else None
+
+        writer = RowWriter(cls.write)
+
+        if snapshot is not None:
+            # we only need what has changed since our last sync
+            yield cls.refresh_snapshot(account, source_filter, snapshot)
+            writer.open()
+            for formatted in snapshot['rows'].values():
+                writer.write_row(formatted)
+            writer.close()
+            app_log.info(
+                "Finished retrieval of {} {} for {}".format(writer.count, cls.Meta.tp_api_call, account._id))
+            return
+
         uri = "{}/api/v1/{}".format(account.tp_url, cls.Meta.tp_api_call)
         query_params = {}
         if where_clause != "":
             query_params['where'] = where_clause
-        if skip > 0:
-            query_params['skip'] = skip
-        page_limit = limit if limit is not None else 1000  # TP API's maximum page size
-        query_params['take'] = page_limit
-        query_params['include'] = cls.get_api_includes()
-
-        uri = '?'.join([uri, urlencode(query_params)])
-        date_re = re.compile(r'\((\d+)([\+\-])(\d+)\)')
-        # hold our counts and track the amount of data we've already streamed
-        # (for maximum response sizes)
-        item_count = 0
-        response_size = 1
+        page_limit = limit if limit is not None else MAX_TAKE
+        query_params['include'] = cls.get_api_includes(extra=['ModifyDate'] if incremental else None)
+
+        # our rows keyed by ID for our snapshot, and the latest modification we've seen
+        rows = OrderedDict()
+        latest_modified, latest_millis = None, None
+
+        def handle_item(item):
+            nonlocal latest_modified, latest_millis
+            # our transformer also converts TP's dates to 8601
+            formatted = cls.format_data_to_schema(item)
+            if incremental:
+                rows[item['Id']] = formatted
+                modified_millis = get_tp_date_millis(item.get('ModifyDate', None))
+                if modified_millis is not None and (latest_millis is None or modified_millis > latest_millis):
+                    latest_modified, latest_millis = item['ModifyDate'], modified_millis
+            writer.write_row(formatted)
 
         # open our list
-        cls.write('[')
-
-        while uri is not None:
-            req = account.get_request(uri)
-
-            response = yield client.fetch(req)
-
-            page_data = response.body.decode('utf-8')
-            resp_obj = json.loads(page_data)
-
-            app_log.info("Start retrieval; first page...")
-            for item in resp_obj['Items']:
-                # convert our dates to something understandable
-                # TP dates come in as something like \/Date(1429890000000-0500)\/
-                # we put them out in 8601
-                for name, field in cls.Schema.get_all_fields():
-                    if not isinstance(field, DateField):
-                        continue
-                    val = item[name]
-                    if val is not None and isinstance(val, str):
-                        search = date_re.search(val)
-                        if search is None:
-                            continue
-                        pieces = search.groups()
-                        timestamp = int(int(pieces[0]) / 1000)
-                        val = parse_date(datetime.fromtimestamp(timestamp).isoformat()
-                                         + ''.join(pieces[1:])).strftime('%Y-%m-%dT%H:%M:%S%z')
-                    item[name] = val
-                formatted = cls.format_data_to_schema(item)
-                response_size += sys.getsizeof(formatted)
-                if item_count > 0:
-                    cls.write(',')
-                cls.write(json.dumps(formatted))
-                item_count += 1
-
-            uri = resp_obj.get('Next', None)
-            if uri is not None:
-                app_log.info(
-                    "Next page for {}, retrieved {} thus far".format(account._id, item_count))
-                # This escapes the filter, otherwise every request past the first will
-                # return a 400
-                uri = uri.replace(' ', '+')
-            else:
-                app_log.info("At end of response for {}".format(account._id))
+        writer.open()
+
+        yield fetch_pages(account, uri, query_params, handle_item, skip=skip, take=page_limit)
+
+        if incremental and latest_modified is not None:
+            snapshots.set(snapshot_key, {'watermark': format_tp_date_for_query(latest_modified), 'rows': rows,
+                                         'refreshes': 0})
         # close our array
-        cls.write(']')
+        writer.close()
         # finish
         app_log.info(
-            "Finished retrieval of {} {} for {}".format(item_count, cls.Meta.tp_api_call, account._id))
+            "Finished retrieval of {} {} for {}".format(writer.count, cls.Meta.tp_api_call, account._id))
 
 
 class TargetprocessAssignable(TargetprocessGeneral):
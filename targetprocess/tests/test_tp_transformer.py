@@ -0,0 +1,85 @@
+from datetime import datetime
+from dateutil.parser import parse as date_parse
+import unittest
+
+from targetprocess.transformer import TargetprocessRowTransformer, convert_tp_date, get_tp_date_millis, \
+    format_tp_date_for_query, tp_date_regex
+from vizydrop.fields import TextField, DateField, IDField
+from vizydrop.sdk.source import SourceSchema
+
+TP_DATES = [
+    '/Date(1429890000000-0500)/',
+    '/Date(1429890000000+0300)/',
+    '/Date(1429890000123+0530)/',
+    '/Date(1429890000000-0000)/',
+    '/Date(1429890000000+0000)/',
+    '/Date(0+0100)/',
+    '/Date(1893456000999-1000)/',
+]
+
+
+def dateutil_convert_tp_date(value):
+    # how TP dates were converted before the transformer, through a full date parser
+    pieces = tp_date_regex.search(value).groups()
+    timestamp = int(int(pieces[0]) / 1000)
+    return date_parse(datetime.fromtimestamp(timestamp).isoformat() + ''.join(pieces[1:])) \
+        .strftime('%Y-%m-%dT%H:%M:%S%z')
+
+
+class TransformerSchema(SourceSchema):
+    Id = IDField(name="ID", description="Entity ID", force_int=True)
+    Name = TextField(name="Name", description="Entity name or title")
+    CreateDate = DateField(name="Create Date", description="Entity creation date")
+    Project = TextField(name="Project", description="Project where entity is found", response_loc="Project-Name")
+    Assignments = TextField(name="Assignment", description="User assigned to this item",
+                            response_loc="Assignments-GeneralUser-LastName")
+
+
+class TargetprocessRowTransformerTests(unittest.TestCase):
+    def test_convert_tp_date_matches_dateutil(self):
+        for value in TP_DATES:
+            self.assertEqual(convert_tp_date(value), dateutil_convert_tp_date(value), value)
+
+    def test_convert_tp_date_leaves_other_values(self):
+        self.assertEqual(convert_tp_date('2015-04-24'), '2015-04-24')
+        self.assertEqual(convert_tp_date(''), '')
+
+    def test_get_tp_date_millis(self):
+        self.assertEqual(get_tp_date_millis('/Date(1429890000123-0500)/'), 1429890000123)
+        self.assertIsNone(get_tp_date_millis('2015-04-24'))
+        self.assertIsNone(get_tp_date_millis(None))
+
+    def test_format_tp_date_for_query(self):
+        # 2015-04-24T15:40:00Z, in the timezone it was given in
+        self.assertEqual(format_tp_date_for_query('/Date(1429890000000-0500)/'), '2015-04-24 10:40:00')
+        self.assertEqual(format_tp_date_for_query('/Date(1429890000000+0530)/'), '2015-04-24 21:10:00')
+
+    def test_includes(self):
+        transformer = TargetprocessRowTransformer(TransformerSchema)
+        self.assertEqual(sorted(transformer.include_fields),
+                         sorted(['Id', 'Name', 'CreateDate', 'Project[Name]', 'Assignments[GeneralUser[LastName]]']))
+        self.assertEqual(transformer.includes, '[{}]'.format(','.join(transformer.include_fields)))
+
+    def test_transform(self):
+        transformer = TargetprocessRowTransformer(TransformerSchema)
+        item = {
+            'Id': 13,
+            'Name': 'Some story',
+            'CreateDate': '/Date(1429890000000-0500)/',
+            'Project': {'Name': 'Some project'},
+            'Assignments': {'Items': [{'GeneralUser': {'LastName': 'Smith'}},
+                                      {'GeneralUser': {'LastName': 'Jones'}}]},
+        }
+        self.assertEqual(transformer.transform(item), {
+            'Id': 13,
+            'Name': 'Some story',
+            'CreateDate': dateutil_convert_tp_date('/Date(1429890000000-0500)/'),
+            'Project': 'Some project',
+            'Assignments': 'Smith,Jones',
+        })
+
+    def test_transform_missing_values(self):
+        transformer = TargetprocessRowTransformer(TransformerSchema)
+        row = transformer.transform({'Id': 13, 'CreateDate': None, 'Project': None,
+                                     'Assignments': {'Items': []}})
+        self.assertEqual(row, {'Id': 13, 'CreateDate': None, 'Project': None, 'Assignments': ''})
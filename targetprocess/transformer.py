@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import re
+
+from vizydrop.fields import DateField
+
+# TP dates come in as something like \/Date(1429890000000-0500)\/
+tp_date_regex = re.compile(r'\((\d+)([\+\-])(\d+)\)')
+
+
+def convert_tp_date(value):
+    """
+    Converts a TP API date to ISO-8601 without going through a full date parser
+    :param value: TP date string, e.g. /Date(1429890000000-0500)/
+    :return: date string formatted as %Y-%m-%dT%H:%M:%S%z, or the value untouched if it isn't a TP date
+    """
+    search = tp_date_regex.search(value)
+    if search is None:
+        return value
+    millis, sign, offset = search.groups()
+    if int(offset) == 0:
+        # a zero offset is always rendered as +0000
+        sign = '+'
+    return datetime.fromtimestamp(int(millis) // 1000).strftime('%Y-%m-%dT%H:%M:%S') + sign + offset
+
+
+def get_tp_date_millis(value):
+    """
+    Gets the epoch milliseconds of a TP API date, for comparing dates without converting them
+    :param value: TP date string, e.g. /Date(1429890000000-0500)/
+    :return: milliseconds since the epoch, or None if the value isn't a TP date
+    """
+    if not isinstance(value, str):
+        return None
+    search = tp_date_regex.search(value)
+    if search is None:
+        return None
+    return int(search.group(1))
+
+
+def format_tp_date_for_query(value):
+    """
+    Formats a TP API date for use in a where clause, in the timezone TP gave it to us in
+    :param value: TP date string, e.g. /Date(1429890000000-0500)/
+    :return: date string formatted as %Y-%m-%d %H:%M:%S
+    """
+    millis, sign, offset = tp_date_regex.search(value).groups()
+    offset = timedelta(hours=int(offset[:-2] or 0), minutes=int(offset[-2:]))
+    if sign == '-':
+        offset = -offset
+    return (datetime.utcfromtimestamp(int(millis) // 1000) + offset).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_location_value(item, keys):
+    """
+    Gets a nested value from a TP API item, flattening any TP collections found along the way
+    :param item: dict to search through
+    :param keys: compiled response location, e.g. ('Assignments', 'GeneralUser', 'LastName')
+    :return: value
+    """
+    for index, key in enumerate(keys):
+        if item is None:
+            return None
+        if 'Items' in item:
+            # handle our inner collections
+            return ','.join([get_location_value(i, keys[index:]) for i in item['Items']])
+        item = item[key]
+    return item
+
+
+class TargetprocessRowTransformer(object):
+    """
+    Converts TP API items to a source schema, with everything we can learn from the schema worked out up front
+    """
+
+    def __init__(self, schema):
+        fields = []
+        includes = []
+        seen = set()
+        for name, field in schema.get_all_fields():
+            # subclassed schemas may list an overridden field more than once
+            if name in seen:
+                continue
+            seen.add(name)
+            if field.response_location is not None:
+                # response locations are delimited by a hyphen
+                keys = tuple(field.response_location.split('-'))
+                # which maps to TP's API x[y[z]] format for include
+                includes.append('['.join(keys) + ']' * (len(keys) - 1))
+            else:
+                # if we have no response location, our name is the location
+                keys = None
+                includes.append(name)
+            fields.append((name, keys, isinstance(field, DateField)))
+        self.fields = tuple(fields)
+        self.include_fields = tuple(includes)
+        self.includes = '[{}]'.format(','.join(includes))
+
+    def transform(self, item):
+        """
+        Formats a single TP API item to our schema, converting TP dates to ISO-8601 along the way
+        :param item: item from the TP API
+        :return: formatted item
+        """
+        row = {}
+        for name, keys, is_date in self.fields:
+            if keys is None:
+                if name not in item:
+                    continue
+                value = item[name]
+            else:
+                value = get_location_value(item, keys)
+            if is_date and isinstance(value, str):
+                value = convert_tp_date(value)
+            row[name] = value
+        return row
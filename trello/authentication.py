@@ -1,7 +1,8 @@
 from tornado import gen
 import json
 
-from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, HTTPError
+from common.http import get_http_client
 import os
 
 from vizydrop.sdk.account import Account, AppOAuthv1Account
@@ -23,7 +24,8 @@ class TrelloOAuth(AppOAuthv1Account):
 
     def get_request(self, url):
         oauth = self.get_client()
-        uri, headers, body = oauth.sign("{}?limit=1000&key={}".format(url, self.Meta.client_key))
+        uri, headers, body = oauth.sign("{}{}limit=1000&key={}".format(url, '&' if '?' in url else '?',
+                                                                      self.Meta.client_key))
         return HTTPRequest(uri, headers=headers, body=body)
 
     @gen.coroutine
@@ -32,7 +34,7 @@ class TrelloOAuth(AppOAuthv1Account):
             return False, "missing token/secret"
         req = self.get_request('https://trello.com/1/members/me')
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
                 return True, None
@@ -44,7 +46,7 @@ class TrelloOAuth(AppOAuthv1Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://trello.com/1/members/me")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
@@ -65,7 +67,8 @@ class TrelloTokenAuth(Account):
                            description="Navigate here to retrieve your access token:")
 
     def get_request(self, url):
-        return HTTPRequest("{}?limit=1000&key={}&token={}".format(url, TrelloOAuth.Meta.client_key, self.token))
+        return HTTPRequest("{}{}limit=1000&key={}&token={}".format(url, '&' if '?' in url else '?',
+                                                                  TrelloOAuth.Meta.client_key, self.token))
 
     @gen.coroutine
     def validate(self):
@@ -73,7 +76,7 @@ class TrelloTokenAuth(Account):
             return False, "missing token"
         req = self.get_request('https://trello.com/1/members/me')
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             resp = yield client.fetch(req)
             if 200 <= resp.code < 300:
                 return True, None
@@ -85,7 +88,7 @@ class TrelloTokenAuth(Account):
     @gen.coroutine
     def get_friendly_name(self):
         try:
-            client = AsyncHTTPClient()
+            client = get_http_client()
             req = self.get_request("https://trello.com/1/members/me")
             resp = yield client.fetch(req)
             resp_data = json.loads(resp.body.decode('utf-8'))
@@ -1,20 +1,30 @@
 import json
-import sys
+from urllib.parse import urlencode
 from tornado import gen
 
-from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPError
+from common.http import get_http_client
+from common.writer import RowWriter
 
 from tornado.log import app_log
 
-from vizydrop.sdk.source import DataSource, SourceSchema, SourceFilter
+from vizydrop.sdk.source import StreamingDataSource, SourceSchema, SourceFilter
 from vizydrop.fields import *
 
-RESPONSE_SIZE_LIMIT = 10  # MB
+# how do we fetch boards? 'nested' makes one request per board, 'batch' groups boards into /batch requests
+BOARD_FETCH_MODE = 'nested'
+# how many boards can go in a single /batch request? (Trello's maximum is 10)
+BATCH_SIZE = 10
+# the card fields our schema needs (id is always included)
+CARD_FIELDS = ['name', 'closed', 'desc', 'dateLastActivity', 'pos', 'due', 'labels', 'idList']
+# a board's name, with its cards and lists as nested resources
+BOARD_QUERY = urlencode({'fields': 'name', 'cards': 'visible', 'card_fields': ','.join(CARD_FIELDS),
+                         'lists': 'all', 'list_fields': 'name'})
 
 
 class TrelloCardSourceFilters(SourceFilter):
     def get_board_options(account, **kwargs):
-        client = AsyncHTTPClient()
+        client = get_http_client()
         req = account.get_request("https://api.trello.com/1/members/me/boards")
         response = yield client.fetch(req)
         options = json.loads(response.body.decode('utf-8'))
@@ -24,7 +34,7 @@ class TrelloCardSourceFilters(SourceFilter):
         return ret
 
     def get_list_options(account, boards, **kwargs):
-        client = AsyncHTTPClient()
+        client = get_http_client()
         ret = []
         if isinstance(boards, str):
             boards = boards.split(',')
@@ -40,7 +50,7 @@ class TrelloCardSourceFilters(SourceFilter):
     lists = MultiListField(name="List", description="Board list", optional=True, get_options=get_list_options)
 
 
-class TrelloCardSource(DataSource):
+class TrelloCardSource(StreamingDataSource):
     class Meta:
         identifier = "cards"
         name = "Cards"
@@ -65,90 +75,64 @@ class TrelloCardSource(DataSource):
     def get_data(cls, account, source_filter, limit=100, skip=0):
         """
         Gathers card information from Trello
-        GET https://api.trello.com/1/boards/[board_id]/cards
+        GET https://api.trello.com/1/boards/[board_id]?cards=visible&lists=all
+            -- or, in batch mode, up to BATCH_SIZE of those at once:
+        GET https://api.trello.com/1/batch?urls=[board routes]
         """
         if not account:
             raise ValueError('cannot gather cards without an account')
-        client = AsyncHTTPClient()
+        client = get_http_client()
 
         app_log.info("Start retrieval of cards")
 
-        cards = []
-        for board in source_filter.boards:
-            app_log.info("Retrieving board {}".format(board))
-
-            try:
-                resp = yield client.fetch(account.get_request("https://api.trello.com/1/boards/{}/name".format(board)))
-            except HTTPError as err:
-                return {"code": err.code, "reason": err.response.reason, "error": err.response.body.decode('utf-8')}
-            else:
-                board_name = json.loads(resp.body.decode('utf-8'))['_value']
-
-            uri = "https://api.trello.com/1/boards/{}/cards".format(board)
-            req = account.get_request(uri)
-            try:
-                response = yield client.fetch(req)
-            except HTTPError as e:
-                return {
-                    "code": e.code,
-                    "reason": e.response.reason,
-                    "error": e.response.body.decode('utf-8')
-                }
-
-            if response.code != 200:
-                return {
-                    "code": response.code,
-                    "reason": response.reason,
-                    "error": response.error
-                }
-            data = response.body.decode('utf-8')
-            resp_obj = json.loads(data)
-
-            for obj in resp_obj:
-                obj['board_name'] = board_name
-
-                if hasattr(source_filter,
-                           'lists') and source_filter.lists is not None and source_filter.lists.__len__() > 0:
-                    if obj['idList'] in source_filter.lists:
-                        cards.append(obj)
-                else:
-                    cards.append(obj)
-            app_log.info("Board {} retrieved {} cards".format(board, cards.__len__()))
-
-            # check our response size
-            if sys.getsizeof(cards) > RESPONSE_SIZE_LIMIT * 1000000:
-                app_log.warn("Request for {} exceeds size limit".format(account._id))
-                raise HTTPError(413)
-
-        list_ids = set([el['idList'] for el in cards])
-        boards = set([el['idBoard'] for el in cards])
-        list_name_map = {}
-        # grab our list names
-        app_log.info("Starting resolution of lists")
-        for board in boards:
-            app_log.info("Resolving list names for {}".format(board))
-            uri = "https://api.trello.com/1/boards/{}/lists".format(board)
-            req = account.get_request(uri)
-            try:
-                response = yield client.fetch(req)
-            except HTTPError as e:
-                return {
-                    "code": e.code,
-                    "reason": e.response.reason,
-                    "error": e.response.body.decode('utf-8')
-                }
-            lists = json.loads(response.body.decode('utf-8'))
-            for list in lists:
-                if list['id'] not in list_ids:
-                    continue
-                list_name_map[list['id']] = list['name']
-            app_log.info("Board {} resolution yielded {} lists".format(board, lists.__len__()))
-
-        for card in cards:
-            card['list'] = list_name_map[card['idList']]
-            card['labels'] = ','.join(label['name'] for label in card['labels'])
-
-        reply_data = cls.format_data_to_schema(cards)
-
-        app_log.info("Source complete, grabbed {} cards".format(cards.__len__()))
-        return json.dumps(reply_data)
+        @gen.coroutine
+        def fetch_boards(group):
+            """
+            Fetches a group of boards along with their cards and lists
+            :return: list of board data, in the order of the group
+            """
+            if BOARD_FETCH_MODE != 'batch':
+                response = yield client.fetch(account.get_request(
+                    "https://api.trello.com/1/boards/{}?{}".format(group[0], BOARD_QUERY)))
+                return [json.loads(response.body.decode('utf-8'))]
+            # commas separate the batched routes, so our routes' own commas stay encoded
+            routes = ','.join("/boards/{}?{}".format(board, BOARD_QUERY) for board in group)
+            response = yield client.fetch(account.get_request(
+                "https://api.trello.com/1/batch?{}".format(urlencode({'urls': routes}))))
+            ret = []
+            for result in json.loads(response.body.decode('utf-8')):
+                if '200' not in result:
+                    raise HTTPError(result.get('statusCode', 500), result.get('message', None))
+                ret.append(result['200'])
+            return ret
+
+        group_size = BATCH_SIZE if BOARD_FETCH_MODE == 'batch' else 1
+        # every group is requested up front, our HTTP client caps how many requests hit Trello at once
+        groups = [fetch_boards(source_filter.boards[n:n + group_size])
+                  for n in range(0, source_filter.boards.__len__(), group_size)]
+
+        filter_lists = hasattr(source_filter, 'lists') and source_filter.lists is not None and \
+            source_filter.lists.__len__() > 0
+
+        # open our list
+        writer = RowWriter(cls.write)
+        writer.open()
+
+        # boards are written in the order they were selected, each as soon as it has arrived
+        for group in groups:
+            boards = yield group
+            for board in boards:
+                list_name_map = {list['id']: list['name'] for list in board['lists']}
+
+                for card in board['cards']:
+                    if filter_lists and card['idList'] not in source_filter.lists:
+                        continue
+                    card['board_name'] = board['name']
+                    card['list'] = list_name_map[card['idList']]
+                    card['labels'] = ','.join(label['name'] for label in card['labels'])
+                    writer.write_row(cls.format_data_to_schema(card))
+                app_log.info("Board {} retrieved, {} cards thus far".format(board['id'], writer.count))
+
+        # close our list
+        writer.close()
+        app_log.info("Source complete, grabbed {} cards".format(writer.count))